@@ -1,147 +1,42 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Output, Input, State
-import covid_19
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
+from dash.dependencies import Output, Input, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 from apscheduler.schedulers.background import BackgroundScheduler
-import subprocess
-import random
 import time
+from datetime import datetime
 import threading
-import unemployment
-import json
-import numpy as np
-import death
-
+import os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import gzip
+from collections import namedtuple
+import figures
+import metrics
+from figures import days_options, update_county_plot, update_state_plot, build_figure_cube
+from lazy import LazyModule
+
+# Imported when a callback or the refresh first needs them, so a worker boots without
+# pandas, plotly or the census tables (see import_budget)
+np = LazyModule("numpy")
+go = LazyModule("plotly.graph_objects")
+px = LazyModule("plotly.express")
+covid_19 = LazyModule("covid_19")
+death = LazyModule("death")
+refresh = LazyModule("refresh")
+snapshot = LazyModule("snapshot")
+unemployment = LazyModule("unemployment")
+
+from flask import request, Response
 from flask_caching import Cache
 
-def state_to_abbr(state):
-    state_map = json.loads(open("name-abbr.json").read())
-    if state in state_map:
-        state = state_map[state]
-    else:
-        if len(state) > 2:
-            state = state[:2]
-    return state
-    
-def plot_county(cases_by_county, county_state, num_days, min_cases=10, lineweight=1, percent=False):
-    cases = cases_by_county[county_state]["cases"]
-    deaths = cases_by_county[county_state]["deaths"]
-    dates = cases_by_county[county_state]["date"]
-    cases, new_cases, dates = covid_19.compute_new_cases(cases, dates, num_days)
-    county, state = county_state
-    if percent:
-        x = dates
-        y = new_cases/cases * 100
-    else:
-        x = cases
-        y = new_cases
-    state = state_to_abbr(state)
-    #label=f"{county}, {state} ({int(cases[-1])}, {int(deaths[-1])})"
-    label=f"{county},{state}({int(deaths[-1])})"
-    return x, y, label
-
-def plot_state(states, state, num_days, min_cases=10, lineweight=1, percent=False):
-    dates = states[state]["date"]
-    deaths = states[state]["deaths"]
-    cases = states[state]["cases"]
-    cases, new_cases, dates = covid_19.compute_new_cases(cases, dates, num_days)
-    if percent:
-        x = dates
-        y = new_cases/cases * 100
-    else:
-        x = cases
-        y = new_cases
-    label=f"{state_to_abbr(state)} ({int(cases[-1])}, {int(deaths[-1])})"
-    return x, y, label
-    
-
-def arrange_counties(sorted_counties, my_counties, top_n):
-    top_counties = sorted_counties[:top_n]
-    bottom_counties = sorted_counties[top_n:]
-    for i, my_county in enumerate(my_counties):
-        if my_county not in sorted_counties:
-            print(f"Huh, {my_county} doesn't exist.")
-        if my_county in sorted_counties:
-            if my_county in sorted_counties and my_county in bottom_counties:
-                top_counties.append(my_county)
-                bottom_counties.remove(my_county)
-            top_n += 1
-    top_counties.extend(bottom_counties)
-    sorted_counties = top_counties
-    return sorted_counties, top_n
-
-def update_county_plot(percent, cases_by_county, num_days):
-    top_n = 10
-    n = 200
-    sorted_counties = covid_19.counties_by_num_cases(cases_by_county)
-    
-    my_counties = [
-        ("Santa Clara", "California"),
-        ("Marin", "California"),
-    ]
-    sorted_counties, top_n = arrange_counties(sorted_counties, my_counties, top_n)
-    sorted_counties = sorted_counties[:n]
-    fig = go.Figure()
-    for i, county_state in enumerate(sorted_counties[:n]):
-        try:
-            lw = 1
-            if county_state in my_counties:
-                lw = 4
-            x, y, label = plot_county(cases_by_county, county_state, num_days = num_days, min_cases=300, lineweight=lw, percent=percent)
-        except covid_19.NotEnoughCases:
-            continue
-        visible=True
-        if i >= top_n:
-            visible='legendonly'
-        fig.add_trace(go.Scatter(x=x, y=y, mode='lines+markers', name=label, visible=visible, line=dict(width=lw)))
-    if percent:
-        fig.update_layout(title="US Counties (deaths in parenthesis)",
-                          xaxis_title="Date",
-                          yaxis_title="Growth rate per day (%)",)
-    else:
-        fig.update_layout(title="US Counties (deaths in parenthesis)",
-                          xaxis_title="Total Number of Cases",
-                          yaxis_title=f"New Cases per day, {num_days} day average",
-                          xaxis_type='log',
-                          yaxis_type='log',)
-    return fig
-
-def update_state_plot(percent, cases_by_state, num_days):
-    top_n = 10
-    states = covid_19.states_by_num_cases(cases_by_state)
-    top_states = states[:top_n]
-    the_rest = states[top_n:]
-    top_states.extend(sorted(the_rest))
-    states = top_states
-    fig = go.Figure()
-    for i, state in enumerate(states):
-        try:
-            x, y, label = plot_state(cases_by_state, state, num_days=num_days, lineweight=1, percent=percent)
-        except covid_19.NotEnoughCases:
-            continue
-        visible=True
-        if i >= top_n:
-            visible='legendonly'
-        fig.add_trace(go.Scatter(x=x, y=y, mode='lines+markers', name=label, visible=visible))
-    if percent:
-        fig.update_layout(title="US States",
-                          xaxis_title="Date",
-                          yaxis_title="Growth rate per day (%)",
-        )
-    else:
-        fig.update_layout(title="US States",
-                          xaxis_title="Total Number of Cases",
-                          yaxis_title=f"New Cases per day, {num_days} day average",
-                          xaxis_type='log',
-                          yaxis_type='log',
-                          
-        )
-    return fig
-
 external_stylesheets = [
 #    'https://codepen.io/chriddyp/pen/bWLwgP.css',
     'https://stackpath.bootstrapcdn.com/bootstrap/4.4.1/css/bootstrap.min.css',
@@ -167,13 +62,14 @@ excess_covid_pct_plot = dcc.Graph(id='excess-covid-unemployment-pct')
 
 covid_pane_controls = html.Div(
     [
-        dcc.Checklist(id='pct-checkbox', options=[{'label' : "Plots as Percent", 'value' : 'PCT'}], value=[]),
+        dcc.Checklist(id='pct-checkbox', options=[{'label' : "Plots as Percent", 'value' : 'PCT'},
+                                                  {'label' : "Per 100k People", 'value' : 'CAPITA'}], value=[]),
         html.Div([
             html.Label("Days to average: "),
             dcc.Slider(
                 id="days-slider",
-                min=1,
-                max=10,
+                min=days_options[0],
+                max=days_options[-1],
                 step=1,
                 value=5,
                 marks={x: str(x) for x in range(11)},
@@ -242,7 +138,10 @@ These are the ones I use for these plots
                     ],
                     id='scale-selector',
                     value=365*5,
-                 )],
+                 ),
+                 # the figures, without a time scale.  The scale is applied in the browser.
+                 dcc.Store(id='employment-figures'),
+                ],
                 className="row"),
             html.Div(
                 [
@@ -279,6 +178,12 @@ title_row = html.Div(
             interval=1,
             n_intervals=0,
         ),
+        # Ticks until the covid plots have data, see stop_data_wait()
+        dcc.Interval(
+            id='data-wait-interval',
+            interval=5*1000,
+            n_intervals=0,
+        ),
         html.Div([html.H1("Crome's COVID-19 plotter"), 'Get the source code at ', html.A("GitHub", href="https://github.com/ccrome/covid-19", target="_blank")], className="col-md-9"),
     ],
     className="row"
@@ -304,63 +209,179 @@ The 2018 and 2019 data isn't available yet.
 )
 main_area = html.Div([title_row, tabs], className="container")
 
-cases_by_county = None
-cases_by_state = None
-country_summary = None
-
-def del_and_clone():
-    print("del and clone")
-    subprocess.call(["rm", "-rf", "covid-19-data"])
-    subprocess.call(["git", "clone", "https://github.com/nytimes/covid-19-data.git"])
-
-def pull():
-    global cases_by_state, cases_by_county, country_summary
-    subprocess.call(["git", "pull"], cwd="covid-19-data")
-    df_county = pd.read_csv("covid-19-data/us-counties.csv")
-    df_state = pd.read_csv("covid-19-data/us-states.csv")
-    cases_by_state = covid_19.df_to_dict_state(df_state)
-    cases_by_county = covid_19.df_to_dict_county(df_county)
-    country_summary = covid_19.summarize_state_data(cases_by_state)
-    
+# Everything the callbacks read, built off to the side and published with a single
+# assignment to 'dataset'.  It's never modified once published, so a callback that
+# reads 'dataset' once sees one consistent version, even while a refresh is running.
+Dataset = namedtuple("Dataset", ["version", "cases_by_county", "cases_by_state", "country_summary", "figure_cube", "figure_bytes"])
+dataset = None
+
+snapshot_dir = "snapshot"
+
+def load_snapshot():
+    """Maps the data (and the figures, if they're there) of the latest snapshot, instead
+    of pulling and parsing it.  Returns False if there's no snapshot."""
+    global dataset
+    with metrics.timed("covid_stage_seconds", stage="snapshot_load"):
+        version, stores = snapshot.read_snapshot(snapshot_dir)
+        if stores is None:
+            return False
+        print(f"loaded snapshot {version}")
+        cases_by_county, cases_by_state = stores["counties"], stores["states"]
+        # the figures stay in their files until a request asks for them
+        figures_path = snapshot.files_path(snapshot_dir, version, "figures")
+        figure_cube = figures.StoredFigures(figures_path)
+        figure_bytes = figures.StoredFigureBytes(figures_path)
+        country_rollup = snapshot.load_object(snapshot_dir, version, "rollup")
+        if country_rollup is not None:
+            country_summary = country_rollup.series("US")
+        else:
+            country_summary = covid_19.summarize_state_data(cases_by_state)
+    dataset = Dataset(version, cases_by_county, cases_by_state, country_summary, figure_cube, figure_bytes)
+    return True
+
+# The refresh (git pull, parsing, series and figures, see refresh.py) runs in a child
+# process, so it doesn't hold the GIL while the callbacks are serving requests.  The
+# child hands back a snapshot, which we just map.  It's spawned, not forked, so it
+# doesn't inherit the threads and locks of the web server.
+refresh_pool = None
+
+def run_refresh():
+    """refresh.update_data() in the child process.  Returns the version of the new snapshot."""
+    global refresh_pool
+    if refresh_pool is None:
+        refresh_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        version = refresh_pool.submit(refresh.update_data, snapshot_dir).result()
+        # the child timed its stages, they're reported here
+        metrics.merge(refresh_pool.submit(metrics.drain).result())
+        return version
+    except BrokenProcessPool:
+        # the child died, start a new one next time
+        refresh_pool = None
+        raise
 
 update_lock = threading.Lock()
 def update_data():
-    global update_lock
+    """Refreshes the data.  Readers never wait for this, they keep using the
+    published dataset until the new one is complete.  If the refresh fails,
+    the published dataset stays as it is."""
     print("updating database")
-    update_lock.acquire()
+    with update_lock, metrics.timed("covid_stage_seconds", stage="update_data"):
+        try:
+            version = run_refresh()
+        except Exception as e:
+            print(f"update failed ({e}).  Keeping the data we have")
+            return
+        if dataset is None or dataset.version != version:
+            load_snapshot()
+
+
+# Only one process (e.g. one of the gunicorn workers) pulls the data and writes the
+# snapshots: whoever holds the lock file.  The others map the snapshots it writes, so
+# there's one git pull and one copy of the data no matter how many workers there are.
+refresher_lock = None
+pull_interval = 3600
+last_pull = 0
+
+def is_refresher():
+    global refresher_lock
+    if refresher_lock is not None:
+        return True
+    if fcntl is None:
+        return True
+    os.makedirs(snapshot_dir, exist_ok=True)
+    f = open(os.path.join(snapshot_dir, ".refresher.lock"), "w")
     try:
-        pull()
-    except:
-        print("update failed.  Trying again")
-        n = random.randint(5, 15)
-        time.sleep(n)
-        del_and_clone()
-        pull()
-    update_lock.release()
-    
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    refresher_lock = f
+    return True
+
+def attach_snapshot():
+    """Switches to the latest snapshot, if it's newer than the data we have"""
+    global dataset
+    version = snapshot.current_version(snapshot_dir)
+    if version is not None and (dataset is None or version != dataset.version):
+        if not load_snapshot():
+            return
+    data = dataset
+    if data is not None and not data.figure_cube:
+        with metrics.timed("covid_stage_seconds", stage="figure_cube"):
+            figure_cube = build_figure_cube(data.cases_by_county, data.cases_by_state)
+        with metrics.timed("covid_stage_seconds", stage="figure_compression"):
+            figure_bytes = figures.figure_bytes(figure_cube) if figures.high_volume else {}
+        dataset = data._replace(figure_cube=figure_cube, figure_bytes=figure_bytes)
+
+def refresh_data():
+    global last_pull
+    if is_refresher():
+        if time.time() - last_pull >= pull_interval:
+            last_pull = time.time()
+            update_data()
+    else:
+        attach_snapshot()
 
 def serve_layout():
     return main_area
 
 def clear_cache():
-    import subprocess
-    subprocess.run(["rm", "-rf", "cache"])
+    """Empties the memoized figures of an earlier run.  The cache directory stays, the
+    cache can't write its files without it."""
+    cache.clear()
 
-clear_cache()
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.title="COVID-19 Dashboard"
 app.layout = serve_layout
 server=app.server
+metrics.install(server)
 cache = Cache(app.server, config={
     'CACHE_TYPE':'filesystem',
     'CACHE_DIR':'cache',
 })
 app.config.suppress_callback_exceptions = True
 
-#del_and_clone()
 scheduler = BackgroundScheduler()
-scheduler.add_job(func=update_data, trigger="interval", seconds=3600) # update the data once an hour
-scheduler.start()
+# the refresher pulls once an hour, the others look for a new snapshot every minute
+scheduler.add_job(func=refresh_data, trigger="interval", seconds=60, next_run_time=datetime.now())
+
+# Importing this module only defines the app.  Clearing the cache and starting the
+# scheduler is init()'s job, so a process that imports it for something else (like the
+# spawned refresh child, see run_refresh) does neither.  gunicorn calls init() when a
+# worker has booted (see gunicorn.conf.py), other servers on the first request.
+init_lock = threading.Lock()
+initialized = False
+
+# The modules the callbacks and the refresh share.  A thread that finds one of them half
+# imported in sys.modules (plotly's validators look for pandas there) fails, so they're
+# imported in one go by warm_up(), before the scheduler's first job or any callback runs.
+warm_up_modules = ("numpy", "pandas", "plotly.graph_objects")
+warmed_up = threading.Event()
+
+def warm_up():
+    try:
+        for name in warm_up_modules:
+            importlib.import_module(name)
+    finally:
+        # if an import failed, the requests fail on it too rather than wait forever
+        warmed_up.set()
+    scheduler.start()
+
+def init():
+    global initialized
+    with init_lock:
+        if initialized:
+            return
+        clear_cache()
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+        initialized = True
+
+@server.before_request
+def init_on_first_request():
+    if not initialized:
+        init()
+    warmed_up.wait()
 
 
 def make_plot(df, x_column, y_column, title, xaxis_label, yaxis_label, mode='lines+markers'):
@@ -389,25 +410,44 @@ def get_unemployment_plots():
     return plots
 
 def update_cases():
-    global cases_by_county, cases_by_state
-    if cases_by_county is None or cases_by_state is None:
-        print("Couldn't get the data.  why is that.  Let's update the data...")
-        update_data()
-        if cases_by_county is None or cases_by_state is None:
-            print("Updated and still can't get the data... drats.")
-            return
-
-@app.callback(
-    [
-        Output('excess-covid-unemployment', 'figure'),
-        Output('excess-covid-unemployment-pct', 'figure'),
-    ],
-    [
-        Input('page-load-interval', 'value'),
-    ],
-)
-@cache.memoize(timeout=3600*4)
-def update_excess_unemployment(pct):
+    """Returns the published dataset, or None while there isn't one yet.  A request never
+    waits for a refresh: on a cold start the scheduler's first refresh_data() makes the
+    snapshot, and until then the callbacks don't update."""
+    if dataset is None:
+        load_snapshot()
+    return dataset
+
+def data_ages():
+    """For /metrics: how long ago the last day of the NYT data was, when its snapshot
+    was written, and when each FRED file was downloaded"""
+    now = time.time()
+    ages = {}
+    data = dataset
+    if data is not None:
+        last_day = covid_19.latest_date(data.cases_by_county).astype("datetime64[s]").astype(np.int64)
+        ages[(("source", "nyt"),)] = now - last_day
+        path = os.path.join(snapshot_dir, data.version)
+        if os.path.exists(path):
+            ages[(("source", "snapshot"),)] = now - os.path.getmtime(path)
+    for fred_id in unemployment.fred_ids:
+        if os.path.exists(f"{fred_id}.csv"):
+            ages[(("source", fred_id),)] = now - os.path.getmtime(f"{fred_id}.csv")
+    return ages
+
+metrics.gauge("covid_data_age_seconds", data_ages)
+
+# The memoized figures are keyed on the version of the data they were built from, so
+# they never have to expire on their own (timeout=0); a new version evicts the old ones.
+memoized_versions = {}
+def evict_superseded(f, version):
+    """Drops the memoized results of f, if they were built from another data version"""
+    if memoized_versions.get(f.__name__) != version:
+        cache.delete_memoized(f)
+        memoized_versions[f.__name__] = version
+
+@cache.memoize(timeout=0)
+@metrics.cache_miss
+def excess_unemployment_figures(version):
     dates, excess_unemployment, excess_as_pct = unemployment.get_excess_covid_claims()
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=dates, y=excess_unemployment, mode='lines+markers'))
@@ -424,18 +464,22 @@ def update_excess_unemployment(pct):
 
 @app.callback(
     [
-        Output('new-unemployment', 'figure'),
-        Output('continuing-unemployment', 'figure'),
-        Output('employment', 'figure'),
-        Output('unemployment', 'figure'),
-        Output('new-unemployment-pct', 'figure'),
+        Output('excess-covid-unemployment', 'figure'),
+        Output('excess-covid-unemployment-pct', 'figure'),
     ],
     [
         Input('page-load-interval', 'value'),
-        Input('scale-selector', 'value'),
-    ])
-@cache.memoize(timeout=3600*4)
-def update_employment_plots(pct_checkbox, scale_days):
+    ],
+)
+@metrics.timed("covid_callback_seconds", callback="update_excess_unemployment")
+def update_excess_unemployment(pct):
+    version = unemployment.data_version(['ICSA'])
+    evict_superseded(excess_unemployment_figures, version)
+    return metrics.cached_call(excess_unemployment_figures, version)
+
+@cache.memoize(timeout=0)
+@metrics.cache_miss
+def employment_figures(version):
     fred_plots = get_unemployment_plots()
 
     icsa_dates, icsa_pct = unemployment.get_as_part_of_employment('ICSA')
@@ -447,30 +491,50 @@ def update_employment_plots(pct_checkbox, scale_days):
                                xaxis_title="Date",
                                yaxis_title="Percent (%)",
     )
-    end=np.datetime64('today')
-    if scale_days is "":
-        start = icsa_dates[0]
-    else:
-        start=end-np.timedelta64(scale_days, 'D')
-    
-    icsa_pct_fig.update_xaxes(range=[start, end])
-    fred_plots['new_claims'].update_xaxes(range=[start, end])
-    fred_plots['cont_claims'].update_xaxes(range=[start, end])
-    fred_plots['employment'].update_xaxes(range=[start, end])
-    fred_plots['unemployment'].update_xaxes(range=[start, end])
-    return fred_plots['new_claims'], fred_plots['cont_claims'], fred_plots['employment'], fred_plots['unemployment'], icsa_pct_fig    
+    figures = [fred_plots['new_claims'], fred_plots['cont_claims'], fred_plots['employment'], fred_plots['unemployment'], icsa_pct_fig]
+    # where the "All" time scale starts
+    return {'figures': figures, 'all_start': str(icsa_dates[0])}
+
+@app.callback(
+    Output('employment-figures', 'data'),
+    [
+        Input('page-load-interval', 'value'),
+    ])
+@metrics.timed("covid_callback_seconds", callback="update_employment_plots")
+def update_employment_plots(pct_checkbox):
+    version = unemployment.data_version()
+    evict_superseded(employment_figures, version)
+    return metrics.cached_call(employment_figures, version)
+
+# Changing the time scale only sets the x axis range of the figures that are already in
+# the browser (assets/unemployment.js), it doesn't go back to the server.
+app.clientside_callback(
+    ClientsideFunction(namespace='unemployment', function_name='rescale'),
+    [
+        Output('new-unemployment', 'figure'),
+        Output('continuing-unemployment', 'figure'),
+        Output('employment', 'figure'),
+        Output('unemployment', 'figure'),
+        Output('new-unemployment-pct', 'figure'),
+    ],
+    [
+        Input('employment-figures', 'data'),
+        Input('scale-selector', 'value'),
+    ])
 
 @app.callback(
     [Output('causes-graph', 'figure'),
      Output('flu-graph', 'figure'),
     ],
-    [Input('page-load-interval', 'value')],
+    [Input('page-load-interval', 'value'),
+     Input('data-wait-interval', 'n_intervals')],
 )
-
-def causes_plot(loader):
-    global cases_by_state, country_summary
-    if cases_by_state is None:
-        update_cases()
+@metrics.timed("covid_callback_seconds", callback="causes_plot")
+def causes_plot(loader, data_wait):
+    data = update_cases()
+    if data is None:
+        raise PreventUpdate
+    country_summary = data.country_summary
     total_deaths = country_summary['deaths'][-1]
     all_fig = go.Figure()
     causes = death.get_causes()
@@ -482,7 +546,7 @@ def causes_plot(loader):
     weekdeaths = country_summary['deaths'][-14:]
     all_fig.add_trace(go.Bar(x=weekdates, y=weekdeaths, name="COVID-19"))
     all_fig.update_layout(barmode='stack')
-    date = cases_by_state["California"]["date"][-1]
+    date = data.cases_by_state["California"]["date"][-1]
     flu_fig = go.Figure()
     flu_deaths_years = [f"{x}" for x in [1918, 2010, 2011, 2012, 2013, 2014, 2015, 2016, 2017, 2018, 2019]]
     flu_deaths_values = np.array([675, 37, 12, 43, 38, 51, 23, 38, 61, 34]) * 1000/365
@@ -496,22 +560,79 @@ def causes_plot(loader):
     )
     return all_fig, flu_fig
 
-@app.callback(
-    [
-        Output('county-plot', 'figure'),
-        Output('state-plot', 'figure'),
-    ],
-    [
-        Input('pct-checkbox', 'value'),
-        Input('days-slider', 'value'),
-    ])
-@cache.memoize(timeout=3600*4)
-def update_plots(percent, days):
-    global cases_by_county, cases_by_state
-    update_cases()
-    county_plot = update_county_plot(percent, cases_by_county, days)
-    state_plot = update_state_plot(percent, cases_by_state, days)
+@metrics.timed("covid_callback_seconds", callback="update_plots")
+def update_plots(checked, days, data_wait=None):
+    data = update_cases()
+    if data is None or days not in days_options:
+        raise PreventUpdate
+    checked = checked or []
+    percent = 'PCT' in checked
+    per_capita = 'CAPITA' in checked
+    hit = (percent, days, per_capita) in data.figure_cube
+    metrics.count("covid_cache_requests_total", function="figure_cube", result="hit" if hit else "miss")
+    if not hit:
+        # not built yet: build it on the spot
+        return (update_county_plot(percent, data.cases_by_county, days, per_capita=per_capita),
+                update_state_plot(percent, data.cases_by_state, days, per_capita=per_capita))
+    county_plot, state_plot = data.figure_cube[percent, days, per_capita]
     return county_plot, state_plot
 
+@server.route("/covid-figures/<int:percent>/<int:days>/<int:per_capita>")
+def covid_figures(percent, days, per_capita):
+    """The county and state figures as JSON, compressed ahead of time (high volume mode).
+    The browser revalidates them with the ETag, so it only downloads a new version."""
+    if days not in days_options or percent not in (0, 1) or per_capita not in (0, 1):
+        return Response(status=404)
+    data = update_cases()
+    if data is None:
+        return Response(status=503)
+    key = (bool(percent), days, bool(per_capita))
+    etag = f"{data.version}-{int(key[0])}-{days}-{int(key[2])}"
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    encoded = data.figure_bytes.get(key)
+    metrics.count("covid_cache_requests_total", function="figure_bytes", result="miss" if encoded is None else "hit")
+    if encoded is None:
+        checked = [name for name, on in (('PCT', key[0]), ('CAPITA', key[2])) if on]
+        encoded = figures.figure_bytes({key: update_plots(checked, days)})[key]
+    encoding = request.accept_encodings.best_match(list(encoded))
+    body = encoded[encoding] if encoding else gzip.decompress(encoded["gzip"])
+    response = Response(body, content_type="application/json")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["ETag"] = f'"{etag}"'
+    return response
+
+county_plot_outputs = [
+    Output('county-plot', 'figure'),
+    Output('state-plot', 'figure'),
+]
+county_plot_inputs = [
+    Input('pct-checkbox', 'value'),
+    Input('days-slider', 'value'),
+    Input('data-wait-interval', 'n_intervals'),
+]
+if figures.high_volume:
+    # the browser gets the figures from covid_figures() (assets/covid.js)
+    app.clientside_callback(ClientsideFunction(namespace='covid', function_name='load_figures'),
+                            county_plot_outputs, county_plot_inputs)
+else:
+    app.callback(county_plot_outputs, county_plot_inputs)(update_plots)
+
+# On a cold start there's no data until the first refresh is done, and the plots above
+# don't update (PreventUpdate, or a 503 from covid_figures).  data-wait-interval fires
+# them again every few seconds until they got their figures, then it stops.
+@app.callback(
+    Output('data-wait-interval', 'disabled'),
+    [Input('data-wait-interval', 'n_intervals')],
+    [State('causes-graph', 'figure'),
+     State('county-plot', 'figure')],
+)
+def stop_data_wait(data_wait, causes_figure, county_figure):
+    return bool(causes_figure) and bool(county_figure)
+
 if __name__ == '__main__':
+    init()
     app.run_server(debug=True, host="0.0.0.0")
@@ -0,0 +1,26 @@
+// Clientside callbacks for the covid pane, see app.py.  Only used in high volume mode.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    covid: {
+        // Gets the county and state figures for the controls from /covid-figures.
+        // They're precompressed JSON, and the browser keeps them until the data changes.
+        // Until the server has data it answers 503, and the plots wait for the next
+        // tick of data-wait-interval.
+        load_figures: function(checked, days, data_wait) {
+            checked = checked || [];
+            var percent = checked.indexOf("PCT") >= 0 ? 1 : 0;
+            var per_capita = checked.indexOf("CAPITA") >= 0 ? 1 : 0;
+            var request = new XMLHttpRequest();
+            request.open("GET", "covid-figures/" + percent + "/" + days + "/" + per_capita, false);
+            request.send();
+            if (request.status === 503) {
+                // no_update is only there on newer renderers, the plots are empty anyway
+                var unchanged = window.dash_clientside.no_update || null;
+                return [unchanged, unchanged];
+            }
+            if (request.status !== 200) {
+                throw new Error("Couldn't get the covid figures: HTTP " + request.status);
+            }
+            return JSON.parse(request.responseText);
+        }
+    }
+});
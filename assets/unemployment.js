@@ -0,0 +1,24 @@
+// Clientside callbacks for the unemployment pane, see app.py
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    unemployment: {
+        // Sets the x axis of the unemployment figures to the selected time scale
+        // (days before today, or "" for all of it).
+        rescale: function(data, scale_days) {
+            if (!data) {
+                var empty = {data: [], layout: {}};
+                return [empty, empty, empty, empty, empty];
+            }
+            var today = new Date();
+            var end = today.toISOString().slice(0, 10);
+            var start = data.all_start;
+            if (scale_days !== "") {
+                start = new Date(today.getTime() - scale_days * 24 * 3600 * 1000).toISOString().slice(0, 10);
+            }
+            return data.figures.map(function(figure) {
+                var layout = Object.assign({}, figure.layout);
+                layout.xaxis = Object.assign({}, layout.xaxis, {range: [start, end], autorange: false});
+                return Object.assign({}, figure, {layout: layout});
+            });
+        }
+    }
+});
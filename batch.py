@@ -0,0 +1,151 @@
+"""Renders the covid_19.py plots headless: one image per PlotSpec, in a process pool.
+
+The new cases tables and rankings are computed once, before the pool starts, and the
+workers only draw.  An image is only rendered again when the data it shows changed,
+see render_batch().
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import covid_19
+
+# One image.  kinds are the rows of plots: True for the growth rate, False for the new
+# cases against the total.  counties ("county,state") and states are plotted on top of
+# the top num_counties/num_states.  state limits the counties to one state, and the
+# states to that state.
+PlotSpec = namedtuple("PlotSpec", ["output", "num_counties", "num_states", "days", "per_capita",
+                                   "counties", "states", "state", "kinds"],
+                      defaults=(10, 10, 5, False, (), (), None, (True, False)))
+
+def read_specs(filename):
+    """The PlotSpecs of a JSON file: a list of objects with the PlotSpec fields"""
+    with open(filename) as f:
+        return [PlotSpec(**{k: tuple(v) if isinstance(v, list) else v for k, v in spec.items()})
+                for spec in json.load(f)]
+
+def select(spec, cases_by_county, cases_by_state):
+    """The keys a spec plots: (counties, my_counties, states, my_states)"""
+    metric = "cases-per-100k" if spec.per_capita else "cases"
+    if spec.state is None:
+        counties = covid_19.counties_by_num_cases(cases_by_county, spec.num_counties, metric)
+        states = covid_19.states_by_num_cases(cases_by_state, spec.num_states, metric)
+    else:
+        ranked = covid_19.counties_by_num_cases(cases_by_county, metric=metric)
+        counties = [c for c in ranked if c[1] == spec.state][:spec.num_counties]
+        states = [spec.state]
+    my_counties = [tuple(c) for c in covid_19.parse_counties(spec.counties)]
+    return counties, my_counties, states, list(spec.states)
+
+def inputs_digest(spec, selection, cases_by_county, cases_by_state):
+    """A hash of the spec and of all the data its image shows"""
+    counties, my_counties, states, my_states = selection
+    h = hashlib.sha1(repr(spec).encode())
+    for store, keys in ((cases_by_county, counties + my_counties), (cases_by_state, states + my_states)):
+        h.update(str(covid_19.latest_date(store)).encode())
+        for key in keys:
+            h.update(repr(key).encode())
+            if key in store:
+                for column in store[key].values():
+                    h.update(column.tobytes())
+    return h.hexdigest()
+
+def draw(spec, selection, cases_by_county, cases_by_state, fig):
+    """Draws the plots of spec on the matplotlib figure fig"""
+    counties, my_counties, states, my_states = selection
+    axes = fig.subplots(nrows=len(spec.kinds), ncols=2, squeeze=False)
+    by = "cases per 100k people" if spec.per_capita else "number of cases"
+    per = " per 100k people" if spec.per_capita else ""
+    where = f"in {spec.state}" if spec.state else "in the USA"
+    def plot(plot_function, store, key, **kwargs):
+        try:
+            plot_function(store, key, num_days=spec.days, per_capita=spec.per_capita, **kwargs)
+        except covid_19.NotEnoughCases:
+            print(f"Not enough cases to plot {key}")
+    for row, percent in enumerate(spec.kinds):
+        county_ax, state_ax = axes[row]
+        for county_state in counties:
+            plot(covid_19.plot_county, cases_by_county, county_state, min_cases=300, axis=county_ax, lineweight=2, style="-", percent=percent)
+        for county_state in my_counties:
+            plot(covid_19.plot_county, cases_by_county, county_state, min_cases=300, axis=county_ax, lineweight=4, style="-", percent=percent)
+        for state in states:
+            plot(covid_19.plot_state, cases_by_state, state, axis=state_ax, lineweight=2, style="-", percent=percent)
+        for state in my_states:
+            plot(covid_19.plot_state, cases_by_state, state, axis=state_ax, lineweight=4, style="-*", percent=percent)
+        for ax in (county_ax, state_ax):
+            ax.grid(True)
+        if row == 0:
+            county_ax.set_title(f"Top {spec.num_counties} counties {where}, by {by}, as of {covid_19.latest_date(cases_by_county)}\nScript last run {covid_19.get_time()}")
+            county_ax.legend(loc="upper left")
+            state_ax.legend(loc="upper left")
+        which_states = spec.state if spec.state else f"Top {spec.num_states} states"
+        state_ax.set_title(f"{which_states}, as of {covid_19.latest_date(cases_by_state)}\nScript last run {covid_19.get_time()}")
+        if percent:
+            county_ax.set_xlabel("Date")
+            state_ax.set_xlabel("Date")
+            for ax in (county_ax, state_ax):
+                ax.set_ylabel(f"Growth Rate per day (%), averaged over {spec.days} days")
+                ax.set_ylim(0, 40)
+        else:
+            state_ax.set_xlabel(f"Total Cases{per}")
+            for ax in (county_ax, state_ax):
+                ax.set_ylabel(f"New Cases{per} per day, averaged over {spec.days} days")
+                if not spec.per_capita:
+                    ax.set_ylim(10**0, 10**4)
+
+# the stores, in the worker processes
+worker_stores = None
+
+def init_worker(cases_by_county, cases_by_state):
+    global worker_stores
+    worker_stores = (cases_by_county, cases_by_state)
+
+def render(job):
+    """Draws one (spec, selection) into spec.output, on a figure without a GUI backend"""
+    from matplotlib.figure import Figure
+    spec, selection = job
+    fig = Figure(figsize=[16, 4 * len(spec.kinds)])
+    draw(spec, selection, *worker_stores, fig)
+    tmp = f"{spec.output}.{os.getpid()}.tmp{os.path.splitext(spec.output)[1]}"
+    fig.savefig(tmp)
+    os.replace(tmp, spec.output)
+    return spec.output
+
+def read_manifest(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def render_batch(specs, cases_by_county, cases_by_state, manifest=".batch-manifest.json", max_workers=None):
+    """Renders the specs whose image is missing or shows changed data, in parallel.
+    manifest keeps the inputs_digest() of every image written.  Returns the outputs written."""
+    done = read_manifest(manifest)
+    for days in {spec.days for spec in specs}:
+        covid_19.new_cases_table(cases_by_county, days)
+        covid_19.new_cases_table(cases_by_state, days)
+    jobs = []
+    digests = {}
+    for spec in specs:
+        selection = select(spec, cases_by_county, cases_by_state)
+        digests[spec.output] = inputs_digest(spec, selection, cases_by_county, cases_by_state)
+        if digests[spec.output] != done.get(spec.output) or not os.path.exists(spec.output):
+            jobs.append((spec, selection))
+    if not jobs:
+        return []
+    # forked workers share the tables computed above instead of getting a pickled copy
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker,
+                             initargs=(cases_by_county, cases_by_state)) as pool:
+        written = list(pool.map(render, jobs))
+    for output in written:
+        done[output] = digests[output]
+    tmp = f"{manifest}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(done, f, indent=1)
+    os.replace(tmp, manifest)
+    return written
@@ -0,0 +1,244 @@
+"""Offline benchmarks of the data pipeline, on synthetic data shaped like the real thing.
+
+    python benchmark.py                      # 1x and 10x, compared with the baseline
+    python benchmark.py --scale 100 --days 300
+    python benchmark.py --update-baseline    # after a change that's meant to be faster
+    python benchmark.py --scale              # only the import time of app.py
+
+generate() writes us-counties.csv/us-states.csv like the NYT data (1x is every county
+of the census estimates, 10x has ten copies of each) and the FRED CSVs.  Every stage is
+reported with its best wall time, its peak traced memory and, for the figures, the size
+of their JSON.  benchmark-baseline.json keeps the numbers of the last --update-baseline,
+so a regression shows up as a diff of that file as well as in the comparison printed.
+
+The startup check imports app.py in a fresh process, the way a gunicorn worker boots.
+It has to stay under import_budget, and mustn't load any of heavy_modules: those are
+imported when a callback or the refresh first needs them (see lazy.py).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# seconds importing app.py may take
+import_budget = 0.75
+heavy_modules = ("pandas", "numpy", "plotly.graph_objects", "plotly.express", "matplotlib", "covid_19", "regions")
+
+def generate(out_dir, scale=1, days=150, seed=0):
+    """Writes the synthetic NYT and FRED files to out_dir"""
+    import regions
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    base_names = regions.counties["CTYNAME"].map(regions.county_name).to_numpy()
+    base_states = regions.counties["STNAME"].to_numpy()
+    base_fips = regions.counties["fips"].to_numpy()
+    copy = np.repeat(np.arange(scale), len(base_names))
+    names = np.tile(base_names, scale).astype(object)
+    names[copy > 0] = names[copy > 0] + " " + (copy[copy > 0] + 1).astype(str)
+    states = np.tile(base_states, scale)
+    fips = np.tile(base_fips, scale)
+    n = len(names)
+    # each county starts reporting on its own day, then grows by a steady-ish rate
+    start = rng.integers(0, days // 2, n)
+    rate = rng.lognormal(1.5, 1.2, n)
+    cases = np.cumsum(rng.poisson(rate[:, None], (n, days)), axis=1, dtype=np.int64) + 1
+    day, county = np.nonzero((np.arange(days)[:, None] >= start[None, :]))
+    dates = (np.datetime64("2020-01-21") + day).astype(str)
+    county_cases = cases[county, day]
+    county_deaths = county_cases // 50
+    pd.DataFrame({"date": dates, "county": names[county], "state": states[county], "fips": fips[county],
+                  "cases": county_cases, "deaths": county_deaths}) \
+        .to_csv(os.path.join(out_dir, "us-counties.csv"), index=False)
+    state_names, state_codes = np.unique(states, return_inverse=True)
+    cell = day * len(state_names) + state_codes[county]
+    size = days * len(state_names)
+    rows = np.bincount(cell, minlength=size)
+    present = np.flatnonzero(rows)
+    pd.DataFrame({"date": (np.datetime64("2020-01-21") + present // len(state_names)).astype(str),
+                  "state": state_names[present % len(state_names)],
+                  "fips": [regions.state_fips.get(s, 0) for s in state_names[present % len(state_names)]],
+                  "cases": np.bincount(cell, weights=county_cases, minlength=size)[present].astype(np.int64),
+                  "deaths": np.bincount(cell, weights=county_deaths, minlength=size)[present].astype(np.int64)}) \
+        .to_csv(os.path.join(out_dir, "us-states.csv"), index=False)
+    # pandas dates end before 1677, which caps the FRED history at about 340 years
+    years = min(20 * scale, 300)
+    end = np.datetime64("2020-05-01")
+    weeks = np.arange(end - 365 * years, end, 7)
+    months = np.arange(end.astype("datetime64[M]") - 12 * years, end.astype("datetime64[M]")).astype("datetime64[D]")
+    fred = {
+        "ICSA": (weeks, rng.integers(200000, 400000, len(weeks))),
+        "CCSA": (weeks, rng.integers(1500000, 3000000, len(weeks))),
+        "LNU02000000": (months, rng.integers(130000, 160000, len(months))),
+        "UNRATE": (months, np.round(rng.uniform(3.5, 10, len(months)), 1)),
+    }
+    for fred_id, (fred_dates, values) in fred.items():
+        pd.DataFrame({"DATE": fred_dates.astype(str), fred_id: values}).to_csv(os.path.join(out_dir, f"{fred_id}.csv"), index=False)
+
+def measure(results, name, f, setup=None, repeat=3):
+    """Runs f() repeat times for the time and once more under tracemalloc for the memory.
+    setup() runs before each, untimed.  Returns what f returned."""
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    if setup:
+        setup()
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results[name] = {"seconds": best, "peak_mb": peak / 2**20}
+    print(f"  {name:<40} {best:9.4f} s {peak / 2**20:9.1f} MB", flush=True)
+    return result
+
+def run(data_dir, repeat=3):
+    """Benchmarks every stage on the files in data_dir.  Returns {stage: numbers}"""
+    import covid_19
+    import figures
+    import unemployment
+    results = {}
+    def figure_size(name, fig):
+        results[name]["json_bytes"] = len(figures.figure_json(fig))
+    def forget(*stores):
+        """Drops the tables cached on the stores, so each run computes them again"""
+        def setup():
+            for store in stores:
+                store.derived.clear()
+                store.rankings.clear()
+        return setup
+
+    county_df = measure(results, "read us-counties.csv", lambda: pd.read_csv(os.path.join(data_dir, "us-counties.csv")), repeat=repeat)
+    state_df = measure(results, "read us-states.csv", lambda: pd.read_csv(os.path.join(data_dir, "us-states.csv")), repeat=repeat)
+    cases_by_county = measure(results, "df_to_dict_county", lambda: covid_19.df_to_dict_county(county_df), repeat=repeat)
+    cases_by_state = measure(results, "df_to_dict_state", lambda: covid_19.df_to_dict_state(state_df), repeat=repeat)
+    measure(results, "add_per_capita_columns", lambda: covid_19.add_per_capita_columns(covid_19.df_to_dict_county(county_df)), repeat=1)
+    covid_19.add_per_capita_columns(cases_by_county)
+    covid_19.add_per_capita_columns(cases_by_state)
+    def each_county():
+        for key in cases_by_county:
+            try:
+                covid_19.compute_new_cases(cases_by_county[key]["cases"], cases_by_county[key]["date"], 5)
+            except covid_19.NotEnoughCases:
+                pass
+    measure(results, "compute_new_cases, every county", each_county, repeat=repeat)
+    measure(results, "compute_all_new_cases, counties", lambda: covid_19.compute_all_new_cases(cases_by_county, 5), repeat=repeat)
+    measure(results, "summarize_state_data", lambda: covid_19.summarize_state_data(cases_by_state), repeat=repeat)
+    measure(results, "counties_by_num_cases, top 200", lambda: covid_19.counties_by_num_cases(cases_by_county, 200),
+            forget(cases_by_county), repeat=repeat)
+    fig = measure(results, "update_county_plot", lambda: figures.update_county_plot(False, cases_by_county, 5),
+                  forget(cases_by_county), repeat=repeat)
+    figure_size("update_county_plot", fig)
+    fig = measure(results, "update_state_plot", lambda: figures.update_state_plot(False, cases_by_state, 5),
+                  forget(cases_by_state), repeat=repeat)
+    figure_size("update_state_plot", fig)
+    cube = measure(results, "build_figure_cube", lambda: figures.build_figure_cube(cases_by_county, cases_by_state),
+                   forget(cases_by_county, cases_by_state), repeat=1)
+    results["build_figure_cube"]["json_bytes"] = sum(len(figures.figure_json(pair)) for pair in cube.values())
+
+    # the FRED files are read from the current directory, marked as just checked so
+    # nothing is fetched
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        for fred_id in unemployment.fred_ids:
+            unemployment.write_meta(f"{fred_id}.csv", {"checked": time.time()})
+        measure(results, "unemployment.get_series, all",
+                lambda: [unemployment.get_series(fred_id) for fred_id in unemployment.fred_ids],
+                unemployment.parsed_series.clear, repeat=repeat)
+        measure(results, "get_unemployment_all", unemployment.get_unemployment_all, repeat=repeat)
+        measure(results, "get_as_part_of_employment", lambda: unemployment.get_as_part_of_employment("ICSA"), repeat=repeat)
+        measure(results, "get_excess_covid_claims", unemployment.get_excess_covid_claims, repeat=repeat)
+    finally:
+        os.chdir(cwd)
+    return results
+
+def startup(repeat=3):
+    """The best time of importing app.py in a fresh process, and the heavy modules that
+    import loaded.  Returns {stage: numbers}."""
+    script = ("import sys, time, json\n"
+              "t = time.perf_counter()\n"
+              "import app\n"
+              "elapsed = time.perf_counter() - t\n"
+              f"print(json.dumps([elapsed, [m for m in {heavy_modules!r} if m in sys.modules]]))\n")
+    best = None
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, "-W", "ignore", "-c", script], cwd=repo_dir,
+                             capture_output=True, text=True, check=True)
+        elapsed, loaded = json.loads(out.stdout.strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {'import app':<40} {best:9.4f} s, budget {import_budget} s")
+    if best > import_budget:
+        print(f"  over the budget by {best - import_budget:.3f} s")
+    if loaded:
+        print(f"  importing app loaded {', '.join(loaded)}")
+    return {"import app": {"seconds": best}}, best <= import_budget and not loaded
+
+def compare(results, baseline):
+    """Prints how much slower/bigger than the baseline each stage got"""
+    for scale, stages in results.items():
+        for name, numbers in stages.items():
+            before = baseline.get(scale, {}).get(name)
+            if before is None:
+                continue
+            changes = []
+            for field, value in numbers.items():
+                if before.get(field):
+                    changes.append(f"{field} {value / before[field]:.2f}x")
+            print(f"  {scale:>4} {name:<40} {', '.join(changes)}")
+
+def rounded(results):
+    """Three significant digits, so the baseline doesn't churn on noise.  The JSON sizes
+    don't vary from run to run, they're kept exact."""
+    return {scale: {name: {field: value if field == "json_bytes" else float(f"{value:.3g}")
+                           for field, value in numbers.items()}
+                    for name, numbers in stages.items()} for scale, stages in results.items()}
+
+def get_args():
+    p = argparse.ArgumentParser(description="Benchmarks of the covid and unemployment data pipeline")
+    p.add_argument("--scale", type=int, nargs="*", default=[1, 10], help="Copies of every county (and 20 years of FRED data each)")
+    p.add_argument("--days", type=int, default=150, help="Days of NYT data")
+    p.add_argument("--repeat", type=int, default=3, help="Runs per stage, the best one counts")
+    p.add_argument("--data-dir", default="bench-data", help="Where the generated files go, kept between runs")
+    p.add_argument("--baseline", default=os.path.join(repo_dir, "benchmark-baseline.json"))
+    p.add_argument("--update-baseline", action="store_true", help="Write the results as the new baseline")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    # the region tables are read from the repo directory
+    os.chdir(repo_dir)
+    print("startup:")
+    results = {}
+    results["startup"], within_budget = startup(args.repeat)
+    for scale in args.scale:
+        data_dir = os.path.abspath(os.path.join(args.data_dir, f"{scale}x-{args.days}d"))
+        if not os.path.exists(os.path.join(data_dir, "UNRATE.csv")):
+            print(f"generating {data_dir}")
+            generate(data_dir, scale, args.days)
+        print(f"{scale}x, {args.days} days:")
+        results[f"{scale}x"] = run(data_dir, args.repeat)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("compared with the baseline:")
+        compare(results, baseline)
+    except FileNotFoundError:
+        baseline = {}
+    if args.update_baseline:
+        baseline.update(rounded(results))
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+            f.write("\n")
+    if not within_budget:
+        sys.exit(1)
@@ -12,8 +12,11 @@ import numpy as np
 import argparse
 import subprocess
 from datetime import datetime
-from collections import defaultdict
 import pprint
+from series_store import SeriesStore, Ranking
+import snapshot
+import regions
+import rollup
 
 class NotEnoughCases(Exception):
     pass
@@ -30,18 +33,34 @@ def get_args():
     p.add_argument("--nc", "--n-counties", type=int, help="plot top 'n' states/counties", default=10)
     p.add_argument("--ns", "--n-states", type=int, help="plot top 'n' states/counties", default=10)
     p.add_argument("-d", "--days", type=int, help="Number of days to average", default=5)
+    p.add_argument("-p", "--per-capita", action="store_true", help="Rank and plot cases per 100k people")
+    p.add_argument("-b", "--batch", help="Render the plots of a JSON file of plot specs (see batch.PlotSpec) instead, "
+                   "headless and in parallel.  Only plots whose data changed are rendered again.")
+    p.add_argument("-j", "--jobs", type=int, help="Number of processes for --batch", default=None)
     args = p.parse_args()
     args.bypass = not args.force
     return args
 
+# NYT_REPO_URL can point at another clone (e.g. a local bare repo) of the NYT data
+nyt_repo_url = os.environ.get("NYT_REPO_URL", "https://github.com/nytimes/covid-19-data.git")
+
 def update_git(bypass):
+    """Clones or pulls the NYT data.  Returns the (previous, current) commit hashes"""
     if not os.path.exists("covid-19-data"):
-        subprocess.run(["git", "clone", "https://github.com/nytimes/covid-19-data.git"])
+        subprocess.run(["git", "clone", nyt_repo_url, "covid-19-data"])
+        return None, git_version("covid-19-data")
     else:
+        old_version = git_version("covid-19-data")
         out = subprocess.run(["git", "pull"], cwd="covid-19-data", capture_output=True)
         if out.stdout.startswith(b'Already up to date.') and bypass:
             print("No Changes")
             exit(0)
+        return old_version, git_version("covid-19-data")
+
+def git_version(path):
+    """The commit hash checked out in the git repo at path"""
+    out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=path, capture_output=True)
+    return out.stdout.decode().strip()
 
 def moving_average(x_, w):
     mavg= x_[:w].sum() / w + np.cumsum(x_[w:] - x_[:-w]) / w
@@ -67,93 +86,204 @@ def compute_new_cases(cases, dates, num_days):
         raise NotEnoughCases()
     return cases, new_cases, dates
 
-def plot_state(states, state, axis, num_days, min_cases=10, lineweight=1, offset=1.0, style="-", percent=False):
-    dates = states[state]["date"]
-    cases = states[state]["cases"]
-    cases, new_cases, dates = compute_new_cases(cases, dates, num_days)
+def compute_all_new_cases(store, num_days):
+    """compute_new_cases for every series of a SeriesStore in one vectorized pass.
+
+    Works on the ragged (offset) layout of the store, and keeps exactly the
+    masking of compute_new_cases: days without new cases are dropped, then the
+    first num_days of the moving average.  Series that would raise
+    NotEnoughCases are left out.  Returns a SeriesStore with the extra columns
+    'new-cases-avg' and 'growth-pct', plus 'cases-per-100k' and 'new-cases-avg-per-100k'
+    if the store has per capita columns (see add_per_capita_columns)."""
+    w = num_days
+    lengths = store.lengths()
+    new_cases = np.diff(store.cases.astype(np.int64), prepend=0)
+    new_cases[store.starts] = 0
+    kept = np.flatnonzero(new_cases > 0)
+    segment = np.repeat(np.arange(len(store)), lengths)[kept]
+    counts = np.bincount(segment, minlength=len(store))
+    kept_starts = np.cumsum(counts) - counts
+    pos = np.arange(len(kept)) - kept_starts[segment]
+    csum = np.insert(np.cumsum(new_cases[kept]), 0, 0)
+
+    valid = counts >= w + 2
+    rows = np.flatnonzero(valid[segment] & (pos >= w))
+    ks = kept_starts[segment[rows]]
+    first_window = csum[ks + w] - csum[ks]
+    drift = (csum[rows + 1] - csum[ks + w]) - (csum[ks + pos[rows] - w + 1] - csum[ks])
+    average = first_window / w + drift / w
+
+    source = kept[rows]
+    out_counts = counts[valid] - w
+    out_stops = np.cumsum(out_counts)
+    keys = [k for k, v in zip(store, valid) if v]
+    derived = SeriesStore(keys, out_stops - out_counts, out_stops,
+                          store.cases[source], store.deaths[source], store.dates[source])
+    derived.add_column("new-cases-avg", average)
+    derived.add_column("growth-pct", average / store.cases[source] * 100)
+    if "per-100k" in store.key_info:
+        factor = store.key_info["per-100k"][segment[rows]]
+        derived.add_column("cases-per-100k", store.cases[source] * factor)
+        derived.add_column("new-cases-avg-per-100k", average * factor)
+    return derived
+
+def new_cases_table(store, num_days):
+    """compute_all_new_cases, computed once per store and number of days"""
+    if num_days not in store.derived:
+        store.derived[num_days] = compute_all_new_cases(store, num_days)
+    return store.derived[num_days]
+
+def get_new_cases_series(store, key, num_days):
+    """The precomputed series of one key: cases, deaths, date, new-cases-avg, growth-pct"""
+    table = new_cases_table(store, num_days)
+    if key not in table:
+        raise NotEnoughCases()
+    return table[key]
+
+def get_new_cases(store, key, num_days, per_capita=False):
+    """Same as compute_new_cases(store[key]['cases'], store[key]['date'], num_days),
+    but sliced out of the precomputed table.  per_capita gives the cases per 100k people."""
+    series = get_new_cases_series(store, key, num_days)
+    if per_capita:
+        return series["cases-per-100k"], series["new-cases-avg-per-100k"], series["date"]
+    return series["cases"], series["new-cases-avg"], series["date"]
+
+def plot_state(states, state, axis, num_days, min_cases=10, lineweight=1, offset=1.0, style="-", percent=False, per_capita=False):
+    cases, new_cases, dates = get_new_cases(states, state, num_days, per_capita)
     if percent:
         axis.plot(dates, new_cases/cases*100, style, label=state, linewidth=lineweight)
     else:
         axis.loglog(cases, new_cases*offset, style, label=state, linewidth=lineweight)
 
 
-def plot_county(cases_by_county, county_state, axis, num_days, min_cases=10, lineweight=1, style="-", percent=False):
-    cases = cases_by_county[county_state]["cases"]
-    dates = cases_by_county[county_state]["date"]
-    cases, new_cases, dates = compute_new_cases(cases, dates, num_days)
+def plot_county(cases_by_county, county_state, axis, num_days, min_cases=10, lineweight=1, style="-", percent=False, per_capita=False):
+    cases, new_cases, dates = get_new_cases(cases_by_county, county_state, num_days, per_capita)
     county, state = county_state
     if percent:
         axis.plot(dates, new_cases/cases*100, style, label=f"{county}, {state}", linewidth=lineweight)
     else:
         axis.loglog(cases, new_cases, style, label=f"{county}, {state}", linewidth=lineweight)
 
+def group_offsets(df, key_columns):
+    """Stable-sorts the rows of df by key_columns.  Returns (order, keys, starts, stops)
+    where rows order[starts[i]:stops[i]] belong to keys[i], in their original (date) order.
+    keys are in order of first appearance, like the old defaultdict."""
+    codes = np.zeros(len(df), dtype=np.int64)
+    for column in key_columns:
+        column_codes, uniques = pd.factorize(df[column])
+        codes = codes * (len(uniques) + 1) + (column_codes + 1)
+    codes, _ = pd.factorize(codes)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    starts = np.insert(bounds, 0, 0)
+    stops = np.append(bounds, len(order))
+    first_rows = df[key_columns].values[order[starts]]
+    if len(key_columns) == 1:
+        keys = list(first_rows[:, 0])
+    else:
+        keys = [tuple(row) for row in first_rows]
+    return order, keys, starts, stops
+
+def grouped_columns(df, key_columns):
+    """keys, starts, stops, and the cases/deaths/date columns sorted by key"""
+    order, keys, starts, stops = group_offsets(df, key_columns)
+    cases = df["cases"].fillna(0).values[order]
+    deaths = df["deaths"].fillna(0).values[order]
+    dates = pd.to_datetime(df["date"]).values.astype("datetime64[D]")[order]
+    return keys, starts, stops, cases, deaths, dates
+
+def df_to_store(df, key_columns):
+    """Columnar ingest shared by the county and state data.  One stable sort, then
+    the cases/deaths/date columns are stored flat in a SeriesStore."""
+    return SeriesStore(*grouped_columns(df, key_columns))
+
+def extend_store(store, df, key_columns):
+    """A new store with the rows of df (newer days) appended to store"""
+    return store.extend(*grouped_columns(df, key_columns))
+
 def df_to_dict_county(df):
-    county_state_cases = np.array(df[["county", "state", "cases", "deaths", "date"]].values, dtype=str)
-    cases_by_county = defaultdict(lambda: {"cases": [], "deaths": [], "date": []})
-    [cases_by_county[county, state]["cases"].append(cases)   for county, state, cases, deaths, date in county_state_cases]
-    [cases_by_county[county, state]["deaths"].append(deaths) for county, state, cases, deaths, date in county_state_cases]
-    [cases_by_county[county, state]["date"].append(date)     for county, state, cases, deaths, date in county_state_cases]
-    for k in cases_by_county:
-        cases_by_county[k]["cases"] = np.array(cases_by_county[k]["cases"], dtype=float)
-        cases_by_county[k]["deaths"] = np.array(cases_by_county[k]["deaths"], dtype=float)
-        cases_by_county[k]["date"] = np.array(cases_by_county[k]["date"])
-    return cases_by_county
+    return df_to_store(df, ["county", "state"])
 
 def summarize_state_data(cases_by_state):
-    by_date = defaultdict(lambda: {'deaths': 0, 'cases': 0})
-    for k in cases_by_state:
-        dates = cases_by_state[k]['date']
-        cases = cases_by_state[k]['new-cases']
-        deaths = cases_by_state[k]['new-deaths']
-        for date, c, d in zip(dates, cases, deaths):
-            by_date[date]['deaths'] += d
-            by_date[date]['cases'] += c
-    deaths = []
-    cases = []
-    dates = []
-    for date in sorted(by_date):
-        deaths.append(by_date[date]['deaths'])
-        cases.append(by_date[date]['cases'])
-        dates.append(date)
-    return {'date': dates, 'cases': cases, 'deaths': deaths}
-
-def df_to_dict_state(df):
-    from collections import defaultdict
-    state_cases = np.array(df[["state", "cases", "deaths", "date"]].values, dtype=str)
-    cases_by_state = defaultdict(lambda: {"cases" : [], "deaths" : [], "date" : []})
-    [cases_by_state[state]["cases"].append(cases)   for state, cases, deaths, date in state_cases]
-    [cases_by_state[state]["deaths"].append(deaths) for state, cases, deaths, date in state_cases]
-    [cases_by_state[state]["date"].append(date)     for state, cases, deaths, date in state_cases]
-    for k in cases_by_state:
-        cases_by_state[k]["cases"]  = np.array(cases_by_state[k]["cases"], dtype=float)
-        cases_by_state[k]["deaths"] = np.array(cases_by_state[k]["deaths"], dtype=float)
-        cases_by_state[k]["date"]   = np.array(cases_by_state[k]["date"])
-        cases_by_state[k]['new-deaths'] = np.insert(np.diff(cases_by_state[k]["deaths"]), 0, 0)
-        cases_by_state[k]['new-cases'] = np.insert(np.diff(cases_by_state[k]["deaths"]), 0, 0)
+    """The national new cases and deaths per day: {'date', 'cases', 'deaths'}"""
+    return rollup.rollup(cases_by_state).series("US")
+
+def add_daily_columns(cases_by_state):
+    """Adds the new-cases/new-deaths per day columns to a state store"""
+    for name in ("cases", "deaths"):
+        new = np.diff(cases_by_state.columns[name], prepend=0)
+        new[cases_by_state.starts] = 0
+        cases_by_state.add_column(f"new-{name}", new)
     return cases_by_state
 
-        
-def counties_by_num_cases(cases_by_county):
-    counties = []
-    for k in cases_by_county:
-        county, state = k
-        n = cases_by_county[k]["cases"][-1]
-        counties.append(((county, state), n))
-    sorted_county_cases = sorted(counties, key=lambda x: x[1])[::-1]
-    sorted_counties = [x[0] for x in sorted_county_cases]
-    return sorted_counties
-
-def states_by_num_cases(cases_by_state):
-    states = []
-    for state in cases_by_state:
-        n = cases_by_state[state]["cases"][-1]
-        states.append((state, n))
-    sorted_state_cases = sorted(states, key=lambda x: x[1])[::-1]
-    sorted_states = [x[0] for x in sorted_state_cases]
-    return sorted_states
-
-def latest_date(df):
-    return df.date.max()
+per_capita = 100000
+
+def add_per_capita_columns(store):
+    """Adds the cases-per-100k and deaths-per-100k columns to a county or state store,
+    from the population of each key (see regions.add_region_info).  They're NaN for the
+    keys without a known population."""
+    if "cases-per-100k" in store.columns:
+        return store
+    factor = per_capita / regions.add_region_info(store)["population"]
+    store.add_key_info("per-100k", factor)
+    rows = np.repeat(factor, store.lengths())
+    store.add_column("cases-per-100k", store.cases * rows)
+    store.add_column("deaths-per-100k", store.deaths * rows)
+    # what was derived before has no per capita columns, derive it again when asked
+    store.derived.clear()
+    store.rankings.clear()
+    return store
+
+def df_to_dict_state(df):
+    return add_daily_columns(df_to_store(df, ["state"]))
+
+def load_stores(data_dir="covid-19-data", snapshot_dir="snapshot"):
+    """(cases_by_county, cases_by_state) for the commit checked out in data_dir.  Maps
+    the snapshot if it's of that commit, otherwise parses the CSVs and writes one."""
+    version = git_version(data_dir)
+    snapshot_version, stores = snapshot.read_snapshot(snapshot_dir)
+    if stores is not None and snapshot_version == version:
+        return stores["counties"], stores["states"]
+    cases_by_county = add_per_capita_columns(df_to_dict_county(pd.read_csv(os.path.join(data_dir, "us-counties.csv"))))
+    cases_by_state = add_per_capita_columns(df_to_dict_state(pd.read_csv(os.path.join(data_dir, "us-states.csv"))))
+    snapshot.write_snapshot(snapshot_dir, version, {"counties": cases_by_county, "states": cases_by_state})
+    return cases_by_county, cases_by_state
+
+def new_cases_over(store, num_days):
+    """The cases added over the last num_days of every key, in key order"""
+    last = store.stops - 1
+    first = np.maximum(last - num_days, store.starts)
+    return store.cases[last] - store.cases[first]
+
+# What the keys of a store can be ranked by: metric -> f(store, num_days), one value per key
+ranking_metrics = {
+    "cases": lambda store, num_days: store.last("cases"),
+    "deaths": lambda store, num_days: store.last("deaths"),
+    "new-cases": new_cases_over,
+    "cases-per-100k": lambda store, num_days: add_per_capita_columns(store).last("cases-per-100k"),
+    "deaths-per-100k": lambda store, num_days: add_per_capita_columns(store).last("deaths-per-100k"),
+    "new-cases-per-100k": lambda store, num_days:
+        new_cases_over(store, num_days) * add_per_capita_columns(store).key_info["per-100k"],
+}
+
+def ranking(store, metric="cases", num_days=7):
+    """The Ranking of the keys of store by metric, computed once per store.
+    num_days only matters for the metrics over a number of days (new-cases)."""
+    key = (metric, num_days)
+    if key not in store.rankings:
+        store.rankings[key] = Ranking(store.key_list, ranking_metrics[metric](store, num_days))
+    return store.rankings[key]
+
+def counties_by_num_cases(cases_by_county, n=None, metric="cases"):
+    """The counties with the most cases (the n first, or all of them), most cases first.
+    metric ranks them by one of the other ranking_metrics instead."""
+    return ranking(cases_by_county, metric).top(len(cases_by_county) if n is None else n)
+
+def states_by_num_cases(cases_by_state, n=None, metric="cases"):
+    return ranking(cases_by_state, metric).top(len(cases_by_state) if n is None else n)
+
+def latest_date(store):
+    return store.dates.max()
 
 def get_time():
     import pytz
@@ -177,65 +307,20 @@ def parse_counties(county_args):
     return c
 
 if __name__=='__main__':
+    import batch
     args = get_args()
     bypass=args.bypass
     update_git(bypass)
 
-    num_counties_to_plot=args.nc
-    num_states_to_plot=args.ns
-    fig, ((county_0, state_0),(county_1, state_1)) = plt.subplots(nrows=2, ncols=2,figsize=[16, 8])
-
-    df_county = pd.read_csv("covid-19-data/us-counties.csv")
-    df_state = pd.read_csv("covid-19-data/us-states.csv")
-
-    cases_by_county = df_to_dict_county(df_county)
-    sorted_counties = counties_by_num_cases(cases_by_county)
-    for county_state in sorted_counties[:num_counties_to_plot]:
-        plot_county(cases_by_county, county_state, num_days = args.days, min_cases=300, axis=county_0, lineweight=2, style="-", percent=True)
-        plot_county(cases_by_county, county_state, num_days = args.days, min_cases=300, axis=county_1, lineweight=2, style="-", percent=False)
-    for county, state in parse_counties(args.counties):
-        county_state = (county, state)
-        plot_county(cases_by_county, county_state, num_days = args.days, min_cases=300, axis=county_0, lineweight=4, style="-", percent=True)
-        plot_county(cases_by_county, county_state, num_days = args.days, min_cases=300, axis=county_1, lineweight=4, style="-", percent=False)
-
-
-    cases_by_state = df_to_dict_state(df_state)
-    states = states_by_num_cases(cases_by_state)
-    my_states=args.states
-
-    base = 1
-    exponent = 10
-    for state in states[:num_states_to_plot]:
-        plot_state(cases_by_state, state, state_0, lineweight=2, num_days=args.days, offset = base**exponent, style="-", percent=True)
-        plot_state(cases_by_state, state, state_1, lineweight=2, num_days=args.days, offset = base**exponent, style="-", percent=False)
-        exponent += 1
-    for state in my_states:
-        plot_state(cases_by_state, state, state_0, lineweight=4, num_days=args.days, offset=base**exponent, style="-*", percent=True)
-        plot_state(cases_by_state, state, state_1, lineweight=4, num_days=args.days, offset=base**exponent, style="-*", percent=False)
-        exponent += 1
-
-    all_axes = [county_0, county_1, state_0, state_1]
-    [ax.grid(True) for ax in all_axes]
-
-    county_0.set_xlabel("Date")
-    county_0.set_title(f"Top {num_counties_to_plot} counties in the USA, by number of cases, as of {latest_date(df_county)}\nScript last run {get_time()}")
-    county_0.legend(loc="upper left")
-
-    state_0.set_xlabel("Date")
-    state_0.set_title(f"Top {num_states_to_plot} states, as of {latest_date(df_state)}\nScript last run {get_time()}")
-    state_0.legend(loc="upper left")
-
-    state_1.set_title(f"Top {num_states_to_plot} states, as of {latest_date(df_state)}\nScript last run {get_time()}")
-    state_1.set_xlabel("Total Cases")
-
-    county_0.set_ylabel(f"Growth Rate per day (%), averaged over {args.days} days")
-    state_0.set_ylabel(f"Growth Rate per day (%), averaged over {args.days} days")
-    county_0.set_ylim(0, 40)
-    state_0.set_ylim(0, 40)
-
-    county_1.set_ylabel(f"New Cases per day, averaged over {args.days} days")
-    state_1.set_ylabel(f"New Cases per day, averaged over {args.days} days")
-    county_1.set_ylim(10**0, 10**4)
-    state_1.set_ylim(10**0, 10**4)
-    fig.savefig("covid_plot.jpg")
-    plt.show()
+    cases_by_county, cases_by_state = load_stores()
+    if args.batch:
+        written = batch.render_batch(batch.read_specs(args.batch), cases_by_county, cases_by_state, max_workers=args.jobs)
+        print(f"{len(written)} plots rendered: {' '.join(written)}")
+    else:
+        import matplotlib.pyplot as plt
+        spec = batch.PlotSpec("covid_plot.jpg", num_counties=args.nc, num_states=args.ns, days=args.days,
+                              per_capita=args.per_capita, counties=args.counties, states=args.states)
+        fig = plt.figure(figsize=[16, 8])
+        batch.draw(spec, batch.select(spec, cases_by_county, cases_by_state), cases_by_county, cases_by_state, fig)
+        fig.savefig(spec.output)
+        plt.show()
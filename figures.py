@@ -0,0 +1,392 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from lazy import LazyModule
+# only the functions use these, app.py imports this module before they're needed
+np = LazyModule("numpy")
+plotly_utils = LazyModule("plotly.utils")
+go = LazyModule("plotly.graph_objects")
+covid_19 = LazyModule("covid_19")
+regions = LazyModule("regions")
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# High volume mode (COVID_HIGH_VOLUME=1): WebGL traces, numbers sent with fewer digits,
+# daily dates sent as a start and a step, and the covid figures served as precompressed
+# JSON (see figure_bytes()) instead of going through the Dash callback.
+high_volume = os.environ.get("COVID_HIGH_VOLUME") == "1"
+
+# Most points a county trace gets (except the highlighted counties, which keep every
+# day).  Longer traces are downsampled with lttb().  None turns that off.
+max_points = 100
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: the indices of n_out of the points (x, y) that
+    keep the shape of the line.  x, y must be numbers, e.g. log10 of a log axis."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # the first and last points, plus one point from each of n_out-2 buckets in between
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_stop = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_stop = n - 1, n
+        cx = x[next_start:next_stop].mean()
+        cy = y[next_start:next_stop].mean()
+        # twice the area of the triangles (a, candidate, average of the next bucket)
+        area = np.abs((x[a] - cx) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+def downsample(x, y, n_out, log_x=False, log_y=False):
+    """x, y reduced to n_out points with lttb(), measured on the axes as plotted"""
+    if n_out is None or len(x) <= n_out:
+        return x, y
+    xs = np.asarray(x)
+    xs = xs.astype("datetime64[D]").astype(np.int64) if xs.dtype.kind == "M" else xs.astype(float)
+    ys = np.asarray(y, dtype=float)
+    # zeros (and below) aren't drawn on a log axis, keep them out of the way of the areas
+    if log_x:
+        xs = np.log10(np.clip(xs, 1e-3, None))
+    if log_y:
+        ys = np.log10(np.clip(ys, 1e-3, None))
+    keep = lttb(xs, ys, n_out)
+    return x[keep], y[keep]
+
+def trace_bytes(x, y):
+    """How many bytes x and y take in the figure JSON"""
+    return len(json.dumps({"x": x, "y": y}, cls=plotly_utils.PlotlyJSONEncoder))
+
+# bytes of trace data of the county figures built so far, before and after downsampling
+payload_stats = {"before": 0, "after": 0}
+
+day_ms = 24 * 60 * 60 * 1000
+
+def round_significant(a, digits=4):
+    """a rounded to digits significant digits, so small values (per 100k) keep theirs.
+    The result is divided (or multiplied) by an exact power of ten, so its JSON is short."""
+    a = np.asarray(a, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        exponent = digits - 1 - np.floor(np.log10(np.abs(a)))
+    exponent = np.where(np.isfinite(exponent), exponent, 0)
+    up = 10.0 ** np.maximum(exponent, 0)
+    down = 10.0 ** np.maximum(-exponent, 0)
+    return np.round(a * up / down) * down / up
+
+def compact_xy(x, y):
+    """The x/y arguments of a trace, in as few bytes as high volume mode can send them"""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if y.dtype.kind == "f":
+        y = round_significant(y)
+    if x.dtype.kind == "M":
+        days = x.astype("datetime64[D]").astype(np.int64)
+        if len(days) > 1 and (np.diff(days) == 1).all():
+            return dict(x0=str(x[0]), dx=day_ms, y=y)
+    elif x.dtype.kind == "f":
+        x = round_significant(x)
+    return dict(x=x, y=y)
+
+def scatter(x, y, **kwargs):
+    """A go.Scatter of x, y, or in high volume mode a go.Scattergl with compact x/y"""
+    if not high_volume:
+        return go.Scatter(x=x, y=y, **kwargs)
+    return go.Scattergl(**compact_xy(x, y), **kwargs)
+
+def figure_json(figs):
+    return json.dumps(figs, cls=plotly_utils.PlotlyJSONEncoder, separators=(",", ":")).encode()
+
+def encode(raw):
+    """JSON compressed, {encoding: bytes}.  There's always "gzip", and "br" if brotli is installed."""
+    encoded = {"gzip": gzip.compress(raw, 9)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(raw)
+    return encoded
+
+def figure_bytes(cube):
+    """The figure pairs of a cube as compressed JSON, {cube key: {encoding: bytes}},
+    to be served as they are"""
+    return {k: encode(figure_json(figs)) for k, figs in cube.items()}
+
+# the file of a cube key in a snapshot, and the suffix of each encoding.  The figures
+# differ between the modes (Scattergl with compact x/y in high volume mode), so the mode
+# is in the name: a restart in the other mode doesn't serve the files of this one.
+encoding_suffixes = {"gzip": ".gz", "br": ".br"}
+figure_mode = "gl" if high_volume else "svg"
+
+def figure_file(key, encoding=None):
+    percent, days, per_capita = key
+    return f"{figure_mode}-{int(percent)}-{days}-{int(per_capita)}.json" + encoding_suffixes.get(encoding, "")
+
+def figure_files(cube):
+    """The figure pairs of a cube as the files of a snapshot, {file name: bytes}: the
+    JSON of each, plus its compressed copies in high volume mode"""
+    files = {}
+    for key, figs in cube.items():
+        raw = figure_json(figs)
+        files[figure_file(key)] = raw
+        if high_volume:
+            for encoding, data in encode(raw).items():
+                files[figure_file(key, encoding)] = data
+    return files
+
+class StoredFigures(Mapping):
+    """The figure pairs of a snapshot's figure_files() in path, {cube key: pair}.  A pair
+    is only read when it's asked for, so the workers share the files through the page
+    cache instead of each keeping the whole cube.  The last few pairs stay decoded."""
+
+    def __init__(self, path, keep=8):
+        self.path = path
+        self.keep = keep
+        self.decoded = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.decoded:
+                self.decoded.move_to_end(key)
+                return self.decoded[key]
+        raw = self.read(figure_file(key))
+        if raw is None:
+            raise KeyError(key)
+        pair = tuple(json.loads(raw))
+        with self.lock:
+            self.decoded[key] = pair
+            while len(self.decoded) > self.keep:
+                self.decoded.popitem(last=False)
+        return pair
+
+    def keys_in(self, names):
+        for name in names:
+            parts = name[:-len(".json")].split("-") if name.endswith(".json") else ()
+            if len(parts) == 4 and parts[0] == figure_mode:
+                yield bool(int(parts[1])), int(parts[2]), bool(int(parts[3]))
+
+    def __iter__(self):
+        try:
+            names = sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            names = []
+        return self.keys_in(names)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+class StoredFigureBytes(StoredFigures):
+    """Like StoredFigures, but {cube key: {encoding: bytes}} of the compressed copies,
+    read every time (they're served as they are)"""
+
+    def __getitem__(self, key):
+        encoded = {}
+        for encoding in encoding_suffixes:
+            data = self.read(figure_file(key, encoding))
+            if data is not None:
+                encoded[encoding] = data
+        if "gzip" not in encoded:
+            raise KeyError(key)
+        return encoded
+
+    def keys_in(self, names):
+        suffix = encoding_suffixes["gzip"]
+        return super().keys_in(name[:-len(suffix)] for name in names if name.endswith(suffix))
+
+def per_capita_xy(series):
+    """The cases and new cases per 100k people of a series.  NotEnoughCases if its
+    population isn't known."""
+    x = series["cases-per-100k"]
+    if np.isnan(x[0]):
+        raise covid_19.NotEnoughCases()
+    return x, series["new-cases-avg-per-100k"]
+
+def plot_county(cases_by_county, county_state, num_days, min_cases=10, lineweight=1, percent=False, per_capita=False):
+    deaths = cases_by_county[county_state]["deaths"]
+    series = covid_19.get_new_cases_series(cases_by_county, county_state, num_days)
+    if percent:
+        x = series["date"]
+        y = series["growth-pct"]
+    elif per_capita:
+        x, y = per_capita_xy(series)
+    else:
+        x = series["cases"]
+        y = series["new-cases-avg"]
+    #label=f"{county}, {state} ({int(cases[-1])}, {int(deaths[-1])})"
+    label=f"{regions.region_name(cases_by_county, county_state)}({int(deaths[-1])})"
+    return x, y, label
+
+def plot_state(states, state, num_days, min_cases=10, lineweight=1, percent=False, per_capita=False):
+    deaths = states[state]["deaths"]
+    series = covid_19.get_new_cases_series(states, state, num_days)
+    cases = series["cases"]
+    if percent:
+        x = series["date"]
+        y = series["growth-pct"]
+    elif per_capita:
+        x, y = per_capita_xy(series)
+    else:
+        x = cases
+        y = series["new-cases-avg"]
+    label=f"{regions.region_name(states, state)} ({int(cases[-1])}, {int(deaths[-1])})"
+    return x, y, label
+    
+
+def arrange_counties(cases_by_county, my_counties, top_n, n, metric="cases"):
+    """The n counties to plot: the top_n ranked highest by metric, then my_counties that
+    aren't among those, then the rest of the ranking.  Returns (counties, top_n), where top_n
+    now counts my_counties too.  Only looks at the first n + len(my_counties) of the ranking."""
+    ranked = covid_19.counties_by_num_cases(cases_by_county, n + len(my_counties), metric)
+    top_counties = ranked[:top_n]
+    bottom_counties = ranked[top_n:]
+    moved = set()
+    for my_county in my_counties:
+        if my_county not in cases_by_county:
+            print(f"Huh, {my_county} doesn't exist.")
+            continue
+        if my_county not in top_counties:
+            top_counties.append(my_county)
+            moved.add(my_county)
+        top_n += 1
+    bottom_counties = [c for c in bottom_counties if c not in moved]
+    return (top_counties + bottom_counties)[:n], top_n
+
+def cached_trace(traces, key, make_trace):
+    """make_trace(), or the trace from an earlier build with the same key.  traces is
+    a dict, or None to not cache.  None stands for a series with NotEnoughCases"""
+    if traces is not None and key in traces:
+        return traces[key]
+    try:
+        trace = make_trace()
+    except covid_19.NotEnoughCases:
+        trace = None
+    if traces is not None:
+        traces[key] = trace
+    return trace
+
+def ranking_metric(per_capita):
+    return "cases-per-100k" if per_capita else "cases"
+
+def cases_titles(per_capita, num_days):
+    """The x and y axis titles of the log-log plots"""
+    per = " per 100k people" if per_capita else ""
+    return f"Total Number of Cases{per}", f"New Cases{per} per day, {num_days} day average"
+
+def update_county_plot(percent, cases_by_county, num_days, traces=None, per_capita=False):
+    top_n = 10
+    n = 200
+    my_counties = [
+        ("Santa Clara", "California"),
+        ("Marin", "California"),
+    ]
+    sorted_counties, top_n = arrange_counties(cases_by_county, my_counties, top_n, n, ranking_metric(per_capita))
+    fig = go.Figure()
+    for i, county_state in enumerate(sorted_counties):
+        lw = 1
+        if county_state in my_counties:
+            lw = 4
+        visible=True
+        if i >= top_n:
+            visible='legendonly'
+        def make_trace():
+            x, y, label = plot_county(cases_by_county, county_state, num_days = num_days, min_cases=300, lineweight=lw, percent=percent, per_capita=per_capita)
+            payload_stats["before"] += trace_bytes(x, y)
+            if county_state not in my_counties:
+                x, y = downsample(x, y, max_points, log_x=not percent, log_y=not percent)
+            payload_stats["after"] += trace_bytes(x, y)
+            return scatter(x, y, mode='lines+markers', name=label, visible=visible, line=dict(width=lw))
+        # the growth rate is the same per capita
+        trace = cached_trace(traces, ("county", county_state, bool(percent), num_days, lw, visible, per_capita and not percent), make_trace)
+        if trace is None:
+            continue
+        fig.add_trace(trace)
+    if percent:
+        fig.update_layout(title="US Counties (deaths in parenthesis)",
+                          xaxis_title="Date",
+                          yaxis_title="Growth rate per day (%)",)
+    else:
+        xaxis_title, yaxis_title = cases_titles(per_capita, num_days)
+        fig.update_layout(title="US Counties (deaths in parenthesis)",
+                          xaxis_title=xaxis_title,
+                          yaxis_title=yaxis_title,
+                          xaxis_type='log',
+                          yaxis_type='log',)
+    return fig
+
+def update_state_plot(percent, cases_by_state, num_days, traces=None, per_capita=False):
+    top_n = 10
+    states = covid_19.states_by_num_cases(cases_by_state, metric=ranking_metric(per_capita))
+    top_states = states[:top_n]
+    the_rest = states[top_n:]
+    top_states.extend(sorted(the_rest))
+    states = top_states
+    fig = go.Figure()
+    for i, state in enumerate(states):
+        visible=True
+        if i >= top_n:
+            visible='legendonly'
+        def make_trace():
+            x, y, label = plot_state(cases_by_state, state, num_days=num_days, lineweight=1, percent=percent, per_capita=per_capita)
+            return scatter(x, y, mode='lines+markers', name=label, visible=visible)
+        trace = cached_trace(traces, ("state", state, bool(percent), num_days, visible, per_capita and not percent), make_trace)
+        if trace is None:
+            continue
+        fig.add_trace(trace)
+    if percent:
+        fig.update_layout(title="US States",
+                          xaxis_title="Date",
+                          yaxis_title="Growth rate per day (%)",
+        )
+    else:
+        xaxis_title, yaxis_title = cases_titles(per_capita, num_days)
+        fig.update_layout(title="US States",
+                          xaxis_title=xaxis_title,
+                          yaxis_title=yaxis_title,
+                          xaxis_type='log',
+                          yaxis_type='log',
+                          
+        )
+    return fig
+
+# every (percent, days, per_capita) combination the covid pane controls can ask for
+days_options = range(1, 11)
+percent_options = (False, True)
+per_capita_options = (False, True)
+
+def build_figure_cube(cases_by_county, cases_by_state, traces=None):
+    """Builds the county and state figures for every position of the covid pane controls.
+    traces caches the individual traces between builds, see cached_trace()"""
+    cube = {}
+    for percent in percent_options:
+        for days in days_options:
+            for per_capita in per_capita_options:
+                cube[percent, days, per_capita] = (
+                    update_county_plot(percent, cases_by_county, days, traces, per_capita),
+                    update_state_plot(percent, cases_by_state, days, traces, per_capita),
+                )
+    return cube
+
+def clean_traces(traces, county_dirty, state_dirty):
+    """The cached traces that are still valid after an update.  dirty is the set of
+    changed counties/states, or None if they all changed"""
+    def still_valid(key):
+        dirty = county_dirty if key[0] == "county" else state_dirty
+        return dirty is not None and key[1] not in dirty
+    return {key: trace for key, trace in traces.items() if still_valid(key)}
@@ -0,0 +1,7 @@
+# gunicorn settings, read with -c (see the Procfile)
+
+def post_worker_init(worker):
+    """The worker has imported app:server, now it clears the cache and starts the
+    warm-up and the refresh scheduler, before it takes requests (see app.init())"""
+    import app
+    app.init()
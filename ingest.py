@@ -0,0 +1,178 @@
+import hashlib
+import io
+import os
+import subprocess
+import numpy as np
+import pandas as pd
+import covid_19
+import metrics
+
+class CsvTail:
+    """Remembers how much of a growing CSV file (like the NYT us-counties.csv) has been
+    ingested, so the next read only has to parse the rows appended since."""
+    chunk_size = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.digest = None
+        self.columns = None
+        self.last_date = None
+
+    def header(self):
+        """The column names of the file"""
+        if self.columns is None:
+            with open(self.path, "rb") as f:
+                self.columns = f.readline().decode().strip().split(",")
+        return self.columns
+
+    def skip_to_end(self):
+        """Marks the whole file as read, without parsing it (after it was ingested some other way)"""
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.offset = data.rfind(b"\n") + 1
+        self.digest = hashlib.sha1(data[:self.offset]).hexdigest()
+        last_line = data[:self.offset].rstrip(b"\n").rsplit(b"\n", 1)[-1]
+        self.last_date = last_line.split(b",", 1)[0].decode()
+
+    def reset(self):
+        """Forgets what was read; the next update is a full read"""
+        self.offset = 0
+        self.digest = None
+        self.last_date = None
+
+    def prefix_hash(self, f, length):
+        h = hashlib.sha1()
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+        return h
+
+    def read_all(self):
+        """Parses the whole file, and remembers where it ended"""
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.offset = data.rfind(b"\n") + 1
+        self.digest = hashlib.sha1(data[:self.offset]).hexdigest()
+        with metrics.timed("covid_stage_seconds", stage="csv_parse"):
+            df = pd.read_csv(io.BytesIO(data[:self.offset]))
+        self.columns = list(df.columns)
+        self.last_date = df.date.max() if len(df) else None
+        return df
+
+    def read_new(self):
+        """Parses only the rows appended since the last read.  Returns None if the file
+        changed some other way (or was never read), and needs a full read_all()."""
+        if self.digest is None or not os.path.exists(self.path):
+            return None
+        if os.path.getsize(self.path) < self.offset:
+            return None
+        with open(self.path, "rb") as f:
+            h = self.prefix_hash(f, self.offset)
+            if h.hexdigest() != self.digest:
+                return None
+            tail = f.read()
+        end = tail.rfind(b"\n") + 1
+        tail = tail[:end]
+        with metrics.timed("covid_stage_seconds", stage="csv_parse"):
+            df = pd.read_csv(io.BytesIO(tail), header=None, names=self.columns)
+        if len(df) and self.last_date is not None and df.date.min() <= self.last_date:
+            # an older day showed up at the end, that's not an append
+            return None
+        h.update(tail)
+        self.digest = h.hexdigest()
+        self.offset += end
+        if len(df):
+            self.last_date = df.date.max()
+        return df
+
+def row_keys(df, key_columns):
+    if len(key_columns) == 1:
+        return list(df[key_columns[0]])
+    return list(zip(*[df[column] for column in key_columns]))
+
+def git_diff_rows(repo, old_version, new_version, filename, columns):
+    """The rows of filename that were removed and added between two commits, as two
+    data frames.  Returns None if the diff isn't only data rows (e.g. the header changed)."""
+    out = subprocess.run(["git", "diff", "--unified=0", "--no-color", "--no-renames",
+                          old_version, new_version, "--", filename], cwd=repo, capture_output=True)
+    if out.returncode != 0:
+        return None
+    removed, added = [], []
+    for line in out.stdout.splitlines():
+        if line.startswith(b"--- ") or line.startswith(b"+++ "):
+            continue
+        if line.startswith(b"-"):
+            rows = removed
+        elif line.startswith(b"+"):
+            rows = added
+        else:
+            continue
+        if not line[1:2].isdigit():
+            return None
+        rows.append(line[1:])
+    def parse(rows):
+        return pd.read_csv(io.BytesIO(b"\n".join(rows) + b"\n"), header=None, names=columns, dtype={"date": str})
+    return parse(removed) if removed else None, parse(added) if added else None
+
+def apply_delta(store, removed, added, key_columns):
+    """Applies a git diff (removed and added rows, either may be None) to store.
+    Only the keys that appear in the diff are rebuilt.  Returns (store, dirty keys)"""
+    removed_keys = row_keys(removed, key_columns) if removed is not None else []
+    added_keys = row_keys(added, key_columns) if added is not None else []
+    dirty = set(removed_keys) | set(added_keys)
+    frames = []
+    for k in dirty:
+        if k not in store:
+            continue
+        series = store[k]
+        frame = pd.DataFrame({
+            "date": np.datetime_as_string(series["date"]),
+            "cases": series["cases"],
+            "deaths": series["deaths"],
+        })
+        for column, value in zip(key_columns, k if len(key_columns) > 1 else (k,)):
+            frame[column] = value
+        frames.append(frame)
+    current = pd.concat(frames, sort=False) if frames else None
+    if current is not None and removed is not None:
+        gone = set(zip(removed_keys, removed.date))
+        current = current[[row not in gone for row in zip(row_keys(current, key_columns), current.date)]]
+    merged = [df for df in (current, added) if df is not None and len(df)]
+    if not merged:
+        return store.replace(dirty, [], [], [], store.cases[:0], store.deaths[:0], store.dates[:0]), dirty
+    merged = pd.concat(merged, sort=False).sort_values("date", kind="mergesort")
+    return store.replace(dirty, *covid_19.grouped_columns(merged, key_columns)), dirty
+
+def update_store(tail, store, key_columns, repo=None, old_version=None, new_version=None):
+    """Brings store up to date with tail.path, doing as little work as it can:
+      - the file only grew: parse just the new rows and append them,
+      - old_version/new_version of the git repo are known: apply the git diff
+        between them, so revised rows only rebuild the counties/states they touch,
+      - otherwise (or the first time) rebuild the store from the whole file.
+    Returns (store, dirty), where dirty is the set of keys that changed, or None
+    if everything has to be treated as changed."""
+    if store is not None:
+        df = tail.read_new()
+        if df is not None:
+            if len(df) == 0:
+                return store, set()
+            with metrics.timed("covid_stage_seconds", stage="store_build"):
+                return covid_19.extend_store(store, df, key_columns), set(row_keys(df, key_columns))
+        if repo is not None and old_version and new_version:
+            with metrics.timed("covid_stage_seconds", stage="git_diff"):
+                diff = git_diff_rows(repo, old_version, new_version, os.path.relpath(tail.path, repo), tail.header())
+            if diff is not None:
+                print(f"delta ingest of {tail.path}")
+                with metrics.timed("covid_stage_seconds", stage="store_build"):
+                    store, dirty = apply_delta(store, *diff, key_columns)
+                tail.skip_to_end()
+                return store, dirty
+    print(f"full ingest of {tail.path}")
+    df = tail.read_all()
+    with metrics.timed("covid_stage_seconds", stage="store_build"):
+        return covid_19.df_to_store(df, key_columns), None
@@ -0,0 +1,28 @@
+"""Modules imported on first use.
+
+    pd = LazyModule("pandas")
+
+binds pd without importing pandas; the first pd.read_csv imports it.  app.py uses this
+for everything only the callbacks and the refresh need, so importing it (and booting a
+gunicorn worker) doesn't wait for pandas, plotly and the census tables.
+"""
+import importlib
+
+class LazyModule:
+    """Stands in for the module name, which is imported when an attribute is first used.
+    Two threads racing for the first use are not safe: while one imports the module,
+    another can find it half imported in sys.modules, and so can code that looks there
+    (plotly does, for pandas).  Import the modules threads share up front (app.warm_up)."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not imported yet"
+        return f"<lazy module {self._name!r}, {state}>"
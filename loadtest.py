@@ -0,0 +1,251 @@
+"""Load test of a running server: concurrent clients replaying browser sessions.
+
+    gunicorn -c gunicorn.conf.py -w 4 --threads 4 app:server &
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 1 8 32
+
+A session is what a browser does: load the page (/, /_dash-layout, /_dash-dependencies
+and the callbacks that fire at startup), then a series of control changes: moves of the
+days slider, the percent and per 100k checkboxes, the unemployment time scale and tab
+switches.  Every change posts the callbacks it triggers to _dash-update-component, the
+way the renderer does.  The time scale and the tabs are handled in the browser in this
+app (see assets/unemployment.js), so they only show up in the report if that changes.
+In high volume mode the covid figures come from /covid-figures (assets/covid.js) and
+are requested like the browser does, revalidating with the ETag it got last time.
+
+Every concurrency runs a cold phase first: the flask_caching directory (--cache-dir,
+the server's must be on this machine) is emptied, then a warm phase with the caches
+filled by the cold one.  For each phase and callback the report has the p50/p95/p99
+latency, the requests per second and the error rate.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# The controls a session changes, and the values it changes them to
+controls = {
+    "days": ("days-slider", "value", list(range(1, 11))),
+    "checkboxes": ("pct-checkbox", "value", [[], ["PCT"], ["CAPITA"], ["PCT", "CAPITA"]]),
+    "time scale": ("scale-selector", "value", [365, 365*5, ""]),
+    "tab": (None, None, ["Causes of Death", "COVID", "Unemployment"]),
+}
+
+class Client:
+    """One kept-alive connection to the server.  request() returns (status, headers, body)."""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.https = parts.scheme == "https"
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.connection is None:
+                connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.connection = connection_class(self.host, timeout=300)
+            try:
+                self.connection.request(method, self.prefix + path, body, headers)
+                response = self.connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError):
+                # the server closed the kept-alive connection, try once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+def layout_values(layout, values=None):
+    """{(id, property): value} of all the components of a /_dash-layout"""
+    if values is None:
+        values = {}
+    if isinstance(layout, list):
+        for child in layout:
+            layout_values(child, values)
+    elif isinstance(layout, dict) and "props" in layout:
+        props = layout["props"]
+        if "id" in props:
+            for name, value in props.items():
+                values[props["id"], name] = value
+        layout_values(props.get("children"), values)
+    return values
+
+def parse_outputs(output):
+    """The (id, property) of the outputs of a dependency, e.g. "..a.figure...b.figure.." """
+    if output.startswith(".."):
+        return [tuple(part.rsplit(".", 1)) for part in output[2:-2].split("...")]
+    return [tuple(output.rsplit(".", 1))]
+
+class Site:
+    """What the server tells the browser on a page load: its callbacks and initial values"""
+
+    def __init__(self, client):
+        status, headers, body = client.request("GET", "/_dash-dependencies")
+        if status != 200:
+            raise RuntimeError(f"Couldn't get /_dash-dependencies: HTTP {status}")
+        self.dependencies = json.loads(body)
+        status, headers, body = client.request("GET", "/_dash-layout")
+        if status != 200:
+            raise RuntimeError(f"Couldn't get /_dash-layout: HTTP {status}")
+        self.initial_values = layout_values(json.loads(body))
+
+    def triggered_by(self, component, prop):
+        return [dependency for dependency in self.dependencies
+                if any(i["id"] == component and i["property"] == prop for i in dependency["inputs"])]
+
+def callback_name(dependency):
+    """The name a callback is reported under: its outputs"""
+    return ",".join(f"{component}.{prop}" for component, prop in parse_outputs(dependency["output"]))
+
+def fire(client, dependency, values, changed, etags, record):
+    """Does what the browser does for one callback: posts it to _dash-update-component,
+    or for a clientside one, the requests its function makes"""
+    clientside = dependency.get("clientside_function")
+    inputs = [dict(i, value=values.get((i["id"], i["property"]))) for i in dependency["inputs"]]
+    if clientside:
+        if (clientside["namespace"], clientside["function_name"]) != ("covid", "load_figures"):
+            return
+        checked = inputs[0]["value"] or []
+        path = f"/covid-figures/{int('PCT' in checked)}/{inputs[1]['value']}/{int('CAPITA' in checked)}"
+        headers = {"Accept-Encoding": "gzip, br"}
+        if path in etags:
+            headers["If-None-Match"] = etags[path]
+        status, response_headers, body = record("/covid-figures", lambda: client.request("GET", path, headers=headers), (200, 304))
+        if status == 200 and response_headers.get("ETag"):
+            etags[path] = response_headers["ETag"]
+        return
+    outputs = [{"id": component, "property": prop} for component, prop in parse_outputs(dependency["output"])]
+    payload = {
+        "output": dependency["output"],
+        "outputs": outputs if len(outputs) > 1 else outputs[0],
+        "inputs": inputs,
+        "state": [dict(s, value=values.get((s["id"], s["property"]))) for s in dependency.get("state", [])],
+        "changedPropIds": [f"{component}.{prop}" for component, prop in changed],
+    }
+    # 204 is a PreventUpdate
+    record(callback_name(dependency), lambda: client.request("POST", "/_dash-update-component", payload), (200, 204))
+
+def run_session(client, site, rng, actions, think, record):
+    """One browser session: the page load, then actions random control changes"""
+    for path in ("/", "/_dash-layout", "/_dash-dependencies"):
+        record(path, lambda: client.request("GET", path), (200,))
+    values = dict(site.initial_values)
+    etags = {}
+    # at startup every callback fires
+    for dependency in site.dependencies:
+        fire(client, dependency, values, [], etags, record)
+    for i in range(actions):
+        if think:
+            time.sleep(rng.uniform(0, 2 * think))
+        name = rng.choice(sorted(controls))
+        component, prop, choices = controls[name]
+        if component is None:
+            # a tab switch, the page has all the tabs already
+            record.client_only(name)
+            continue
+        values[component, prop] = rng.choice(choices)
+        triggered = site.triggered_by(component, prop)
+        if not any(not d.get("clientside_function") or d["clientside_function"]["namespace"] == "covid" for d in triggered):
+            record.client_only(name)
+        for dependency in triggered:
+            fire(client, dependency, values, [(component, prop)], etags, record)
+
+class Recorder:
+    """The latencies and errors of one phase, by callback or path"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.client_only_actions = defaultdict(int)
+
+    def __call__(self, name, request, ok_statuses):
+        t = time.perf_counter()
+        try:
+            status, headers, body = request()
+        except (http.client.HTTPException, OSError) as e:
+            status, headers, body = None, {}, str(e).encode()
+        elapsed = time.perf_counter() - t
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            if status not in ok_statuses:
+                self.errors[name] += 1
+        return status, headers, body
+
+    def client_only(self, name):
+        with self.lock:
+            self.client_only_actions[name] += 1
+
+def empty_cache(cache_dir):
+    """Deletes what's in the flask_caching directory.  The directory itself stays, the
+    server couldn't write its cache files any more without it."""
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def run_phase(url, site, concurrency, sessions, actions, think, seed):
+    """sessions sessions, concurrency at a time.  Returns (Recorder, wall time)"""
+    record = Recorder()
+    clients = threading.local()
+    def session(i):
+        if not hasattr(clients, "client"):
+            clients.client = Client(url)
+        run_session(clients.client, site, random.Random(seed + i), actions, think, record)
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(session, range(sessions)))
+    return record, time.perf_counter() - t
+
+def report(phase, concurrency, record, elapsed):
+    print(f"\n{phase}, {concurrency} concurrent clients, {elapsed:.1f} s")
+    width = max([len("callback or path")] + [len(name) for name in record.latencies])
+    print(f"  {'callback or path':<{width}} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'errors':>7}")
+    for name in sorted(record.latencies):
+        latencies = np.array(record.latencies[name]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        error_rate = record.errors[name] / len(latencies)
+        print(f"  {name:<{width}} {len(latencies):>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {len(latencies) / elapsed:>8.1f} {error_rate:>7.1%}")
+    total = sum(len(latencies) for latencies in record.latencies.values())
+    errors = sum(record.errors.values())
+    print(f"  {'all':<{width}} {total:>6} {'':>9} {'':>9} {'':>9} {total / elapsed:>8.1f} {errors / max(total, 1):>7.1%}")
+    if record.client_only_actions:
+        print("  handled in the browser, no request: " +
+              ", ".join(f"{n} {name}" for name, n in sorted(record.client_only_actions.items())))
+
+def get_args():
+    p = argparse.ArgumentParser(description="Replays browser sessions against a running server, concurrently")
+    p.add_argument("--url", default="http://127.0.0.1:8050", help="Where the server runs")
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrent clients, one run for each")
+    p.add_argument("--sessions", type=int, default=50, help="Sessions per phase")
+    p.add_argument("--actions", type=int, default=10, help="Control changes per session, after the page load")
+    p.add_argument("--think", type=float, default=0, help="Average pause (s) between the changes of a session")
+    p.add_argument("--cache-dir", default="cache", help="The server's flask_caching directory, emptied for the cold phase")
+    p.add_argument("--seed", type=int, default=0)
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    site = Site(Client(args.url))
+    for concurrency in args.concurrency:
+        empty_cache(args.cache_dir)
+        for phase in ("cold cache", "warm cache"):
+            record, elapsed = run_phase(args.url, site, concurrency, args.sessions, args.actions, args.think, args.seed)
+            report(phase, concurrency, record, elapsed)
@@ -0,0 +1,270 @@
+"""Counters and timers of the hot paths, served in the Prometheus text format.
+
+    with metrics.timed("covid_stage_seconds", stage="git_pull"):
+        ...
+    metrics.count("covid_cache_requests_total", function="employment_figures", result="hit")
+
+install() adds /metrics to the flask server, and times every request on the way.
+Every process keeps its own numbers: the refresh child hands its numbers to the web
+process after each refresh (drain() and merge()), each gunicorn worker reports its own.
+
+The sampling profiler (Profiler) is off unless COVID_PROFILER is set, then
+/metrics/profile/start and /metrics/profile/stop switch it on and off while the server
+runs, and /metrics/profile shows the stacks it saw, in the folded format flamegraph.pl
+and speedscope read.
+"""
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# the upper bounds (seconds) of the histogram buckets
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# name: (type, help)
+descriptions = {
+    "covid_stage_seconds": ("histogram", "Time spent in a stage of the data refresh, the figures or the FRED data"),
+    "covid_refresh_failures_total": ("counter", "Refreshes that failed, and were retried from a fresh clone"),
+    "covid_callback_seconds": ("histogram", "Time spent in a Dash callback, without the serialization"),
+    "covid_request_seconds": ("histogram", "Time spent on a request, serialization included"),
+    "covid_requests_total": ("counter", "Requests served"),
+    "covid_response_bytes_total": ("counter", "Bytes of the response bodies"),
+    "covid_cache_requests_total": ("counter", "Lookups in a cache, by result (hit or miss)"),
+    "covid_cache_hit_ratio": ("gauge", "Hits over lookups of a cache, since the process started"),
+    "covid_data_age_seconds": ("gauge", "How old the data served is"),
+}
+
+lock = threading.Lock()
+# (name, labels): value, labels is a sorted tuple of (label, value)
+counters = collections.defaultdict(float)
+# (name, labels): [count of each bucket..., count of all, sum]
+histograms = {}
+# name: function returning {labels: value}, called when /metrics is read
+gauges = {}
+
+def labels_of(labels):
+    return tuple(sorted(labels.items()))
+
+def count(name, value=1, **labels):
+    with lock:
+        counters[name, labels_of(labels)] += value
+
+def observe(name, seconds, **labels):
+    key = name, labels_of(labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+@contextmanager
+def timed(name, **labels):
+    """Observes how long the block takes, works as a decorator too"""
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t, **labels)
+
+def gauge(name, function):
+    """Reports function() under name, whenever /metrics is read.  function returns
+    {labels: value}, with the labels as a dict's items, e.g. {(("source", "nyt"),): 3600}"""
+    gauges[name] = function
+
+# Which calls under a flask_caching memoize actually ran, see cache_miss() and cached_call()
+calls = threading.local()
+
+def cache_miss(f):
+    """Decorates the function under @cache.memoize, so cached_call() knows it ran"""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        calls.missed = True
+        return f(*args, **kwargs)
+    return wrapper
+
+def cached_call(f, *args):
+    """f(*args), f being memoized over a cache_miss() function, counted as a hit or a miss"""
+    calls.missed = False
+    with timed("covid_stage_seconds", stage=f"cached_{f.__name__}"):
+        result = f(*args)
+    count("covid_cache_requests_total", function=f.__name__, result="miss" if calls.missed else "hit")
+    return result
+
+def hit_ratios():
+    lookups = collections.defaultdict(float)
+    hits = collections.defaultdict(float)
+    with lock:
+        for (name, labels), value in counters.items():
+            if name == "covid_cache_requests_total":
+                function = dict(labels)["function"]
+                lookups[function] += value
+                if dict(labels)["result"] == "hit":
+                    hits[function] += value
+    return {(("function", function),): hits[function] / total for function, total in lookups.items() if total}
+
+gauge("covid_cache_hit_ratio", hit_ratios)
+
+def drain():
+    """Takes the counters and histograms of this process, for merge() in another one"""
+    global counters, histograms
+    with lock:
+        state = dict(counters), histograms
+        counters, histograms = collections.defaultdict(float), {}
+    return state
+
+def merge(state):
+    """Adds the counters and histograms of drain() to this process'"""
+    other_counters, other_histograms = state
+    with lock:
+        for key, value in other_counters.items():
+            counters[key] += value
+        for key, other in other_histograms.items():
+            histogram = histograms.setdefault(key, [0] * (len(buckets) + 2))
+            for i, value in enumerate(other):
+                histogram[i] += value
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def render():
+    """All the metrics, in the Prometheus text format"""
+    samples = collections.defaultdict(list)
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            samples[name].append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            for bound, bucket in zip(buckets, histogram):
+                samples[name].append(f"{name}_bucket{format_labels(labels, [('le', f'{bound:g}')])} {bucket}")
+            samples[name].append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram[-2]}")
+            samples[name].append(f"{name}_count{format_labels(labels)} {histogram[-2]}")
+            samples[name].append(f"{name}_sum{format_labels(labels)} {histogram[-1]:g}")
+    for name, function in list(gauges.items()):
+        try:
+            values = function()
+        except Exception as e:
+            print(f"Couldn't get {name}: {e}")
+            continue
+        for labels, value in sorted(values.items()):
+            samples[name].append(f"{name}{format_labels(labels)} {value:g}")
+    lines = []
+    for name in sorted(samples):
+        kind, help_text = descriptions.get(name, ("untyped", name))
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + samples[name]
+    return "\n".join(lines) + "\n"
+
+class Profiler:
+    """Samples the stacks of all the threads (but its own) every interval seconds, and
+    counts them in the folded format: "outer;...;inner count" """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+profiler = None
+
+def endpoint_of(request):
+    """What a request is reported as: the Dash outputs of a callback, or the route"""
+    if request.path.endswith("_dash-update-component"):
+        body = request.get_json(silent=True) or {}
+        return f"callback:{body.get('output', '?')}"
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+def install(server):
+    """Adds /metrics (and the profiler routes, with COVID_PROFILER set) to server, and
+    times all its requests"""
+    from flask import Response, g, request
+
+    @server.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            endpoint = endpoint_of(request)
+            observe("covid_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+            count("covid_requests_total", endpoint=endpoint, status=response.status_code)
+            size = response.calculate_content_length()
+            if size is not None:
+                count("covid_response_bytes_total", size, endpoint=endpoint)
+        return response
+
+    @server.route("/metrics")
+    def serve_metrics():
+        return Response(render(), content_type="text/plain; version=0.0.4")
+
+    if not os.environ.get("COVID_PROFILER"):
+        return
+
+    @server.route("/metrics/profile/start")
+    def start_profiler():
+        global profiler
+        interval = float(request.args.get("interval", 0.01))
+        if profiler is None or not profiler.running():
+            profiler = Profiler(interval)
+            profiler.start()
+        return Response(f"profiling every {profiler.interval} s\n", content_type="text/plain")
+
+    @server.route("/metrics/profile/stop")
+    def stop_profiler():
+        if profiler is not None:
+            profiler.stop()
+        return Response("stopped\n", content_type="text/plain")
+
+    @server.route("/metrics/profile")
+    def serve_profile():
+        if profiler is None:
+            return Response("the profiler never ran, see /metrics/profile/start\n", status=404, content_type="text/plain")
+        return Response(profiler.folded(), content_type="text/plain")
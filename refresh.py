@@ -0,0 +1,93 @@
+"""The data refresh: git pull, ingest, derived series and the covid figures.
+
+app.py runs this in a child process, so none of it competes with the callbacks
+for the GIL.  The child stays alive between refreshes and keeps what it built
+last time in this module, so refreshes stay incremental.  The result is handed
+back as a snapshot (see snapshot.py) that the web process maps.
+"""
+import random
+import subprocess
+import time
+import covid_19
+import ingest
+import snapshot
+import figures
+import metrics
+import rollup
+from figures import clean_traces
+
+data_dir = "covid-19-data"
+county_tail = ingest.CsvTail(f"{data_dir}/us-counties.csv")
+state_tail = ingest.CsvTail(f"{data_dir}/us-states.csv")
+
+# what the last refresh built, the starting point of the next one
+version = None
+cases_by_county = None
+cases_by_state = None
+traces = {}
+figure_files = None
+country_rollup = None
+
+def del_and_clone():
+    print("del and clone")
+    subprocess.call(["rm", "-rf", data_dir])
+    subprocess.call(["git", "clone", covid_19.nyt_repo_url, data_dir])
+
+def pull(snapshot_dir):
+    """Pulls the NYT data, brings the series and figures up to date and writes them as
+    a snapshot.  Returns the version of the snapshot."""
+    global version, cases_by_county, cases_by_state, traces, figure_files, country_rollup
+    with metrics.timed("covid_stage_seconds", stage="git_pull"):
+        subprocess.call(["git", "pull"], cwd=data_dir)
+    new_version = covid_19.git_version(data_dir)
+    try:
+        new_cases_by_state, state_dirty = ingest.update_store(
+            state_tail, cases_by_state, ["state"], data_dir, version, new_version)
+        new_cases_by_county, county_dirty = ingest.update_store(
+            county_tail, cases_by_county, ["county", "state"], data_dir, version, new_version)
+        if state_dirty == set() and county_dirty == set() and figure_files is not None:
+            print("No new data")
+            new_traces, new_figure_files = traces, figure_files
+            new_country_rollup = country_rollup
+        else:
+            with metrics.timed("covid_stage_seconds", stage="derived_columns"):
+                if state_dirty != set():
+                    covid_19.add_daily_columns(new_cases_by_state)
+                covid_19.add_per_capita_columns(new_cases_by_state)
+                covid_19.add_per_capita_columns(new_cases_by_county)
+            with metrics.timed("covid_stage_seconds", stage="rollup"):
+                new_country_rollup = rollup.update_rollup(country_rollup, cases_by_state, new_cases_by_state, state_dirty)
+            new_traces = clean_traces(traces, county_dirty, state_dirty)
+            figures.payload_stats.update(before=0, after=0)
+            with metrics.timed("covid_stage_seconds", stage="figure_cube"):
+                new_cube = figures.build_figure_cube(new_cases_by_county, new_cases_by_state, new_traces)
+            print(f"county traces built: {figures.payload_stats['before']} bytes of data, "
+                  f"{figures.payload_stats['after']} after downsampling to {figures.max_points} points")
+            # one JSON file per figure pair, the web workers read the ones they serve
+            with metrics.timed("covid_stage_seconds", stage="figure_serialization"):
+                new_figure_files = figures.figure_files(new_cube)
+    except:
+        # the tails may already be past rows that never got used
+        state_tail.reset()
+        county_tail.reset()
+        raise
+    version, cases_by_county, cases_by_state, traces, figure_files, country_rollup = \
+        new_version, new_cases_by_county, new_cases_by_state, new_traces, new_figure_files, new_country_rollup
+    with metrics.timed("covid_stage_seconds", stage="snapshot_write"):
+        snapshot.write_snapshot(snapshot_dir, version, {"counties": cases_by_county, "states": cases_by_state},
+                                {"rollup": country_rollup}, {"figures": figure_files})
+    return version
+
+def update_data(snapshot_dir):
+    """pull(), and if that fails, clone the data from scratch and try once more"""
+    try:
+        with metrics.timed("covid_stage_seconds", stage="pull"):
+            return pull(snapshot_dir)
+    except Exception as e:
+        metrics.count("covid_refresh_failures_total")
+        print(f"update failed ({e}).  Trying again")
+        n = random.randint(5, 15)
+        time.sleep(n)
+        with metrics.timed("covid_stage_seconds", stage="clone_and_pull"):
+            del_and_clone()
+            return pull(snapshot_dir)
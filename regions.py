@@ -0,0 +1,76 @@
+"""Names, abbreviations, FIPS codes and populations of the states and counties.
+
+The lookup tables are read once, when the module is imported.  add_region_info()
+turns them into key info of a SeriesStore (one value per key, saved with the
+snapshot), so making a plot label is an array lookup.
+"""
+import json
+import numpy as np
+import pandas as pd
+
+def read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+name_to_abbr = read_json("name-abbr.json")
+
+# The census county names have a suffix the NYT names don't have
+county_suffixes = (" City and Borough", " Census Area", " Municipality", " Borough", " County", " Parish")
+
+def county_name(census_name):
+    for suffix in county_suffixes:
+        if census_name.endswith(suffix):
+            return census_name[:-len(suffix)]
+    return census_name
+
+def read_census(filename="co-est2019-alldata.csv"):
+    """The state and county rows of the census population estimates, with their FIPS code"""
+    census = pd.read_csv(filename, encoding="latin-1",
+                         usecols=["SUMLEV", "STATE", "COUNTY", "STNAME", "CTYNAME", "POPESTIMATE2019"])
+    # 2 digits for a state, 5 for a county
+    census["fips"] = np.where(census["SUMLEV"] == 40, census["STATE"], census["STATE"] * 1000 + census["COUNTY"])
+    return census
+
+census = read_census()
+states = census[census["SUMLEV"] == 40]
+counties = census[census["SUMLEV"] == 50]
+state_fips = dict(zip(states["STNAME"], states["fips"]))
+county_fips = dict(zip(zip(counties["CTYNAME"].map(county_name), counties["STNAME"]), counties["fips"]))
+population_by_fips = dict(zip(census["fips"], census["POPESTIMATE2019"]))
+# The NYT reports the five boroughs together as New York City
+nyc_boroughs = ("New York", "Kings", "Queens", "Bronx", "Richmond")
+county_fips[("New York City", "New York")] = -2
+population_by_fips[-2] = sum(population_by_fips[county_fips[(borough, "New York")]] for borough in nyc_boroughs)
+
+def state_to_abbr(state):
+    if state in name_to_abbr:
+        state = name_to_abbr[state]
+    else:
+        if len(state) > 2:
+            state = state[:2]
+    return state
+
+def add_region_info(store):
+    """Adds the key info 'abbr' (of the state), 'fips' (-1 where it isn't known),
+    'name' (as the plots label the key) and 'population' (the 2019 estimate, NaN where
+    it isn't known) to a county or state store, unless it's there.  Returns store.key_info."""
+    if "name" in store.key_info:
+        return store.key_info
+    keys = store.key_list
+    if keys and isinstance(keys[0], tuple):
+        abbrs = [state_to_abbr(state) for county, state in keys]
+        fips = [county_fips.get(key, -1) for key in keys]
+        names = [f"{county},{abbr}" for (county, state), abbr in zip(keys, abbrs)]
+    else:
+        abbrs = [state_to_abbr(state) for state in keys]
+        fips = [state_fips.get(state, -1) for state in keys]
+        names = abbrs
+    store.add_key_info("abbr", np.array(abbrs, dtype=str))
+    store.add_key_info("fips", np.array(fips, dtype=np.int32))
+    store.add_key_info("name", np.array(names, dtype=str))
+    store.add_key_info("population", np.array([population_by_fips.get(f, np.nan) for f in fips], dtype=np.float64))
+    return store.key_info
+
+def region_name(store, key):
+    """The name of key as the plots label it, e.g. "Santa Clara,CA" or "CA" """
+    return str(add_region_info(store)["name"][store.positions[key]])
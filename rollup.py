@@ -0,0 +1,150 @@
+"""Daily totals of the series of a store, summed over regions (the nation, the states,
+or any other grouping of the keys).
+
+rollup() sums the day over day increase of every row in one bincount.  update_rollup()
+brings a rollup up to date after an ingest: for the keys that only got new days it
+adds just the new rows, other changed keys are taken out and added back in.
+"""
+import numpy as np
+
+def nation(key):
+    return "US"
+
+def state_of(key):
+    """The state of a county key, or the state itself"""
+    return key[1] if isinstance(key, tuple) else key
+
+def ranges(starts, stops):
+    """The concatenation of range(start, stop) for all the starts/stops"""
+    lengths = stops - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum()) + offsets
+
+class Rollup:
+    """totals[column][region, day] is the increase of column on first_day + day, summed over
+    the keys of region.  totals["rows"] counts the rows behind it, a day is only reported
+    for a region if it has rows."""
+    columns = ("cases", "deaths")
+
+    def __init__(self, groupings):
+        self.groupings = tuple(groupings)
+        self.regions = []
+        self.region_index = {}
+        self.first_day = None
+        self.totals = {name: np.zeros((0, 0), dtype=np.int64) for name in self.columns + ("rows",)}
+
+    def copy(self):
+        other = Rollup(self.groupings)
+        other.regions = list(self.regions)
+        other.region_index = dict(self.region_index)
+        other.first_day = self.first_day
+        other.totals = {name: total.copy() for name, total in self.totals.items()}
+        return other
+
+    def region_codes(self, keys):
+        """(key position, region code) pairs of all the keys in all the groupings"""
+        positions = []
+        codes = []
+        for region_of in self.groupings:
+            for i, key in enumerate(keys):
+                region = region_of(key)
+                if region is None:
+                    continue
+                if region not in self.region_index:
+                    self.region_index[region] = len(self.regions)
+                    self.regions.append(region)
+                positions.append(i)
+                codes.append(self.region_index[region])
+        return np.asarray(positions, dtype=np.int64), np.asarray(codes, dtype=np.int64)
+
+    def fit(self, first_day, last_day):
+        """Grows the totals to all the regions and to the days first_day..last_day"""
+        if self.first_day is None:
+            self.first_day = first_day
+        old_days = self.totals["rows"].shape[1]
+        new_first = min(self.first_day, first_day)
+        n_days = max(self.first_day + old_days - 1, last_day) - new_first + 1
+        before = self.first_day - new_first
+        for name, total in self.totals.items():
+            if total.shape != (len(self.regions), n_days):
+                grown = np.zeros((len(self.regions), n_days), dtype=np.int64)
+                grown[:total.shape[0], before:before + total.shape[1]] = total
+                self.totals[name] = grown
+        self.first_day = new_first
+
+    def add(self, store, rows, sign=1):
+        """Adds (sign=-1: takes out) the daily increases of the rows of store"""
+        if len(rows) == 0:
+            return
+        key_of_row = np.searchsorted(store.stops, rows, side="right")
+        keys, key_rank = np.unique(key_of_row, return_inverse=True)
+        positions, codes = self.region_codes([store.key_list[i] for i in keys])
+        order = np.argsort(positions, kind="stable")
+        positions, codes = positions[order], codes[order]
+        days = store.dates[rows].astype(np.int64)
+        self.fit(int(days.min()), int(days.max()))
+        n_days = self.totals["rows"].shape[1]
+        # every row once for each region its key is in
+        first = np.searchsorted(positions, np.arange(len(keys)), side="left")[key_rank]
+        last = np.searchsorted(positions, np.arange(len(keys)), side="right")[key_rank]
+        row_of_cell = np.repeat(np.arange(len(rows)), last - first)
+        cells = codes[ranges(first, last)] * n_days + (days - self.first_day)[row_of_cell]
+        shape = (len(self.regions), n_days)
+        for name in self.columns:
+            values = store.columns[name]
+            increase = values[rows].astype(np.int64) - values[np.maximum(rows - 1, 0)]
+            increase[rows == store.starts[key_of_row]] = 0
+            total = np.bincount(cells, weights=increase[row_of_cell], minlength=shape[0] * shape[1])
+            self.totals[name] += sign * total.round().astype(np.int64).reshape(shape)
+        self.totals["rows"] += sign * np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+
+    def series(self, region):
+        """{'date', 'cases', 'deaths'} of the days region has data for, like summarize_state_data"""
+        i = self.region_index[region]
+        days = np.flatnonzero(self.totals["rows"][i] > 0)
+        dates = (days + self.first_day).astype("datetime64[D]")
+        return {"date": dates, **{name: self.totals[name][i, days] for name in self.columns}}
+
+def rollup(store, groupings=(nation,)):
+    """The Rollup of all the rows of store.  groupings are functions from a key to its
+    region (None to leave it out), e.g. (nation, state_of, {county: metro}.get)."""
+    result = Rollup(groupings)
+    result.add(store, np.arange(len(store.cases)))
+    return result
+
+def update_rollup(old_rollup, old_store, new_store, dirty):
+    """The rollup of new_store, from old_rollup (the rollup of old_store) and dirty, the
+    keys that changed (see ingest.update_store, None if they all did)"""
+    if old_rollup is None or old_store is None or dirty is None:
+        return rollup(new_store, old_rollup.groupings if old_rollup is not None else (nation,))
+    if not dirty:
+        return old_rollup
+    result = old_rollup.copy()
+    in_both = [k for k in dirty if k in old_store.index and k in new_store.index]
+    old_only = [k for k in dirty if k in old_store.index and k not in new_store.index]
+    new_only = [k for k in dirty if k not in old_store.index and k in new_store.index]
+    old_positions = np.array([old_store.positions[k] for k in in_both], dtype=np.int64)
+    new_positions = np.array([new_store.positions[k] for k in in_both], dtype=np.int64)
+    old_starts, old_stops = old_store.starts[old_positions], old_store.stops[old_positions]
+    new_starts, new_stops = new_store.starts[new_positions], new_store.stops[new_positions]
+    # a key that only got new days still has its old rows first, unchanged
+    old_lengths = old_stops - old_starts
+    appended = (new_stops - new_starts) >= old_lengths
+    old_rows = ranges(old_starts[appended], old_stops[appended])
+    new_rows = ranges(new_starts[appended], new_starts[appended] + old_lengths[appended])
+    changed = np.zeros(len(old_rows), dtype=bool)
+    for name in ("cases", "deaths", "date"):
+        changed |= old_store.columns[name][old_rows] != new_store.columns[name][new_rows]
+    row_key = np.repeat(np.arange(appended.sum()), old_lengths[appended])
+    appended[appended] = np.bincount(row_key, weights=changed, minlength=appended.sum()) == 0
+    revised = ~appended
+    old_index = lambda keys: np.array([old_store.positions[k] for k in keys], dtype=np.int64)
+    new_index = lambda keys: np.array([new_store.positions[k] for k in keys], dtype=np.int64)
+    gone = np.concatenate([old_positions[revised], old_index(old_only)])
+    result.add(old_store, ranges(old_store.starts[gone], old_store.stops[gone]), -1)
+    added = np.concatenate([new_positions[revised], new_index(new_only)])
+    result.add(new_store, np.concatenate([
+        ranges(new_starts[appended] + old_lengths[appended], new_stops[appended]),
+        ranges(new_store.starts[added], new_store.stops[added]),
+    ]))
+    return result
@@ -0,0 +1,150 @@
+from collections.abc import Mapping
+import numpy as np
+
+class SeriesStore(Mapping):
+    """All the series of one data set (counties or states) in flat, contiguous arrays.
+
+    cases/deaths are int32, dates are datetime64[D].  The rows of each key are
+    the contiguous slice index[key] == (start, stop), so store[key]["cases"]
+    is a zero-copy view, just like the old dict of dicts of arrays.
+    """
+    def __init__(self, keys, starts, stops, cases, deaths, dates):
+        self.key_list = list(keys)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.columns = {
+            "cases": np.ascontiguousarray(cases, dtype=np.int32),
+            "deaths": np.ascontiguousarray(deaths, dtype=np.int32),
+            "date": np.ascontiguousarray(dates, dtype="datetime64[D]"),
+        }
+        self.index = {k: (int(start), int(stop)) for k, start, stop in zip(self.key_list, self.starts, self.stops)}
+        self.positions = {k: i for i, k in enumerate(self.key_list)}
+        # per key values (e.g. names, FIPS codes), aligned with key_list
+        self.key_info = {}
+        # derived series (e.g. moving averages) cached with the data they came from
+        self.derived = {}
+        # Rankings of the keys, by metric, see covid_19.ranking()
+        self.rankings = {}
+
+    @property
+    def cases(self):
+        return self.columns["cases"]
+
+    @property
+    def deaths(self):
+        return self.columns["deaths"]
+
+    @property
+    def dates(self):
+        return self.columns["date"]
+
+    def add_column(self, name, values):
+        """Adds a flat column, aligned with cases/deaths/date"""
+        values = np.ascontiguousarray(values)
+        if len(values) != len(self.cases):
+            raise ValueError(f"column {name} has {len(values)} rows, expected {len(self.cases)}")
+        self.columns[name] = values
+
+    def add_key_info(self, name, values):
+        """Adds an array with one value per key, in key order"""
+        values = np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError(f"key info {name} has {len(values)} values, expected {len(self)}")
+        self.key_info[name] = values
+
+    def lengths(self):
+        return self.stops - self.starts
+
+    def last(self, name):
+        """The latest value of column 'name' for every key, in key order"""
+        return self.columns[name][self.stops - 1]
+
+    def extend(self, keys, starts, stops, cases, deaths, dates):
+        """Returns a new store with more rows, grouped like the constructor arguments.
+        The rows of each key go after the rows already stored for that key; keys that
+        aren't in the store yet go at the end.  Extra columns and key info are not carried over."""
+        return self.replace((), keys, starts, stops, cases, deaths, dates)
+
+    def replace(self, dirty, keys, starts, stops, cases, deaths, dates):
+        """Like extend(), but first drops all the rows of the keys in dirty.  Dirty keys
+        that don't get any new rows are dropped from the store."""
+        lengths = np.asarray(stops) - np.asarray(starts)
+        codes = {k: i for i, k in enumerate(self.key_list)}
+        key_list = list(self.key_list)
+        key_codes = []
+        for k in keys:
+            if k not in codes:
+                codes[k] = len(key_list)
+                key_list.append(k)
+            key_codes.append(codes[k])
+        old_codes = np.repeat(np.arange(len(self)), self.lengths())
+        dirty_codes = [codes[k] for k in dirty if k in self.index]
+        keep = ~np.isin(old_codes, dirty_codes)
+        row_codes = np.concatenate([old_codes[keep], np.repeat(np.asarray(key_codes, dtype=np.int64), lengths)])
+        order = np.argsort(row_codes, kind="stable")
+        counts = np.bincount(row_codes, minlength=len(key_list))
+        live = counts > 0
+        counts = counts[live]
+        new_stops = np.cumsum(counts)
+        return SeriesStore([k for k, l in zip(key_list, live) if l], new_stops - counts, new_stops,
+                           np.concatenate([self.cases[keep], cases])[order],
+                           np.concatenate([self.deaths[keep], deaths])[order],
+                           np.concatenate([self.dates[keep], dates])[order])
+
+    def __getitem__(self, key):
+        start, stop = self.index[key]
+        return {name: column[start:stop] for name, column in self.columns.items()}
+
+    def __iter__(self):
+        return iter(self.key_list)
+
+    def __len__(self):
+        return len(self.key_list)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+class Ranking:
+    """The keys of a store ranked by one value per key, largest first.  Ties go to the
+    key that comes later in the store, like sorted(..., key=value)[::-1].  NaN ranks last.
+
+    top(k) only partitions the values, it doesn't sort all of them."""
+    def __init__(self, keys, values):
+        self.key_list = list(keys)
+        values = np.asarray(values, dtype=np.float64)
+        self.values = np.where(np.isnan(values), -np.inf, values)
+        self.tops = {}
+        self.ranks = None
+
+    def top_indices(self, k):
+        """The store positions of the k highest ranked keys, highest first"""
+        n = len(self.values)
+        k = max(0, min(k, n))
+        if k not in self.tops:
+            if k == 0:
+                candidates = np.arange(0)
+            elif k < n:
+                # everything tied with the k-th largest value is a candidate
+                threshold = np.partition(self.values, n - k)[n - k]
+                candidates = np.flatnonzero(self.values >= threshold)
+            else:
+                candidates = np.arange(n)
+            order = np.lexsort((candidates, self.values[candidates]))[::-1]
+            self.tops[k] = candidates[order[:k]]
+        return self.tops[k]
+
+    def top(self, k):
+        """The k highest ranked keys, highest first"""
+        return [self.key_list[i] for i in self.top_indices(k)]
+
+    def rank(self, key):
+        """The position of key in the ranking, 0 is the highest.  KeyError if it's not ranked."""
+        if self.ranks is None:
+            self.ranks = {self.key_list[i]: rank for rank, i in enumerate(self.top_indices(len(self)))}
+        return self.ranks[key]
+
+    def __len__(self):
+        return len(self.key_list)
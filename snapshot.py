@@ -0,0 +1,123 @@
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+from series_store import SeriesStore
+
+# Bump this when the files of a snapshot change, older snapshots are then ignored.
+snapshot_format = 4
+
+def save_store(store, path):
+    """Writes a SeriesStore as a directory of .npy files plus the key index"""
+    os.makedirs(path)
+    np.save(os.path.join(path, "starts.npy"), store.starts)
+    np.save(os.path.join(path, "stops.npy"), store.stops)
+    for name, column in store.columns.items():
+        np.save(os.path.join(path, f"column-{name}.npy"), column)
+    for name, values in store.key_info.items():
+        np.save(os.path.join(path, f"info-{name}.npy"), values)
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump({"keys": store.key_list, "columns": list(store.columns), "derived": list(store.derived),
+                   "info": list(store.key_info)}, f)
+    # the precomputed new cases tables, so readers don't each compute their own copy
+    for num_days, derived in store.derived.items():
+        save_store(derived, os.path.join(path, f"derived-{num_days}"))
+
+def load_store(path, mmap_mode="r"):
+    """Maps a store written by save_store.  With mmap_mode="r" nothing is read until it's used."""
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+    keys = [tuple(k) if isinstance(k, list) else k for k in index["keys"]]
+    load = lambda name: np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+    columns = {name: load(f"column-{name}.npy") for name in index["columns"]}
+    store = SeriesStore(keys, load("starts.npy"), load("stops.npy"),
+                        columns.pop("cases"), columns.pop("deaths"), columns.pop("date"))
+    for name, column in columns.items():
+        store.add_column(name, column)
+    for name in index.get("info", []):
+        store.add_key_info(name, load(f"info-{name}.npy"))
+    for num_days in index["derived"]:
+        store.derived[num_days] = load_store(os.path.join(path, f"derived-{num_days}"), mmap_mode)
+    return store
+
+def write_snapshot(root, version, stores, objects=None, files=None):
+    """Writes the stores ({name: SeriesStore}), any other objects ({name: picklable}) and
+    files ({directory name: {file name: bytes}}, read with files_path()) as snapshot
+    'version' under root, then points root/CURRENT at it.  Parts that are already there
+    are kept, and so is the snapshot written before.  Readers only ever see
+    complete files."""
+    final = os.path.join(root, version)
+    if not os.path.exists(final):
+        tmp = os.path.join(root, f".{version}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, store in stores.items():
+            save_store(store, os.path.join(tmp, name))
+        with open(os.path.join(tmp, "snapshot.json"), "w") as f:
+            json.dump({"format": snapshot_format, "version": version, "stores": list(stores)}, f)
+        os.rename(tmp, final)
+    for name, obj in (objects or {}).items():
+        path = os.path.join(final, f"{name}.pickle")
+        if not os.path.exists(path):
+            tmp = os.path.join(root, f".{name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+    for name, contents in (files or {}).items():
+        directory = files_path(root, version, name)
+        os.makedirs(directory, exist_ok=True)
+        for file_name, data in contents.items():
+            path = os.path.join(directory, file_name)
+            if not os.path.exists(path):
+                tmp = os.path.join(root, f".{file_name}.{os.getpid()}.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+    current = os.path.join(root, f".CURRENT.{os.getpid()}.tmp")
+    with open(current, "w") as f:
+        f.write(version)
+    os.replace(current, os.path.join(root, "CURRENT"))
+    # The newest of the others stays until the next snapshot: the workers serve it until
+    # they notice this one (a minute at most), and read its figure files meanwhile.
+    # Older ones go; workers that still map their .npy files keep those until they let go.
+    others = [os.path.join(root, name) for name in os.listdir(root)
+              if name not in (version, "CURRENT") and not name.startswith(".")]
+    for path in sorted(others, key=os.path.getmtime)[:-1]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def load_object(root, version, name):
+    """An object written with write_snapshot(..., objects), or None if it isn't there"""
+    try:
+        with open(os.path.join(root, version, f"{name}.pickle"), "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+def files_path(root, version, name):
+    """The directory of the files written with write_snapshot(..., files)"""
+    return os.path.join(root, version, name)
+
+def current_version(root):
+    """The version root/CURRENT points at, or None"""
+    try:
+        with open(os.path.join(root, "CURRENT")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def read_snapshot(root, mmap_mode="r"):
+    """Returns (version, {name: SeriesStore}) of the current snapshot, or (None, None)
+    if there isn't a usable one"""
+    version = current_version(root)
+    if version is None:
+        return None, None
+    path = os.path.join(root, version)
+    try:
+        with open(os.path.join(path, "snapshot.json")) as f:
+            meta = json.load(f)
+        if meta["format"] != snapshot_format:
+            return None, None
+        return version, {name: load_store(os.path.join(path, name), mmap_mode) for name in meta["stores"]}
+    except (OSError, ValueError, KeyError):
+        return None, None
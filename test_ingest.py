@@ -0,0 +1,109 @@
+"""The incremental ingest (ingest.update_store) and rollup (rollup.update_rollup) against
+a full rebuild, over a local bare repo standing in for the NYT one.  Every commit of
+the stand-in is pulled and ingested the way refresh.pull() does it."""
+import subprocess
+import numpy as np
+import pandas as pd
+import covid_19
+import ingest
+import rollup
+
+county_header = "date,county,state,fips,cases,deaths"
+state_header = "date,state,fips,cases,deaths"
+
+def git(cwd, *args):
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                   cwd=cwd, check=True, capture_output=True)
+
+def write_csv(path, header, rows):
+    """rows are tuples of the columns after the date, {date: [rows]}, written in date order"""
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for date in sorted(rows):
+            for row in rows[date]:
+                f.write(",".join(str(value) for value in (date,) + row) + "\n")
+
+def state_rows(county_rows):
+    """The us-states.csv rows of some us-counties.csv rows"""
+    rows = {}
+    for date, counties in county_rows.items():
+        totals = {}
+        for county, state, fips, cases, deaths in counties:
+            fips, old_cases, old_deaths = totals.get(state, (fips // 1000, 0, 0))
+            totals[state] = (fips, old_cases + cases, old_deaths + deaths)
+        rows[date] = [(state, fips, cases, deaths) for state, (fips, cases, deaths) in totals.items()]
+    return rows
+
+def day(n):
+    return str(np.datetime64("2020-03-01") + n)
+
+def commits():
+    """The us-counties.csv rows of each commit: the first one, then an append, a revision
+    of past rows, a deletion and a new county with a history"""
+    rows = {day(n): [("Kings", "New York", 36047, 10 * n + 1, n),
+                     ("Queens", "New York", 36081, 5 * n + 2, 0),
+                     ("Franklin", "Ohio", 39049, 3 * n, n // 2)] for n in range(5)}
+    yield rows
+    rows = dict(rows)
+    for n in range(5, 7):
+        rows[day(n)] = [("Kings", "New York", 36047, 10 * n + 1, n),
+                        ("Queens", "New York", 36081, 5 * n + 2, 0),
+                        ("Franklin", "Ohio", 39049, 3 * n, n // 2)]
+    yield rows
+    rows = dict(rows)
+    rows[day(2)] = [("Kings", "New York", 36047, 30, 3)] + rows[day(2)][1:]
+    rows[day(3)] = [row if row[0] != "Franklin" else ("Franklin", "Ohio", 39049, 4, 1) for row in rows[day(3)]]
+    yield rows
+    rows = {date: [row for row in counties if row[0] != "Queens" and (row[0], date) != ("Kings", day(4))]
+            for date, counties in rows.items()}
+    yield rows
+    rows = dict(rows)
+    for n in range(3, 8):
+        rows[day(n)] = rows.get(day(n), []) + [("Cuyahoga", "Ohio", 39035, 7 * n, 1)]
+    yield rows
+
+def assert_same_store(store, expected):
+    assert sorted(store.key_list) == sorted(expected.key_list)
+    for key in expected.key_list:
+        for column in ("cases", "deaths", "date"):
+            np.testing.assert_array_equal(store[key][column], expected[key][column], err_msg=f"{key} {column}")
+
+def assert_same_rollup(result, expected):
+    assert sorted(result.regions) == sorted(expected.regions)
+    for region in expected.regions:
+        got, want = result.series(region), expected.series(region)
+        for column in ("date", "cases", "deaths"):
+            np.testing.assert_array_equal(got[column], want[column], err_msg=f"{region} {column}")
+
+def test_incremental_ingest_matches_full_rebuild(tmp_path):
+    upstream, seed, data = tmp_path / "upstream.git", tmp_path / "seed", tmp_path / "covid-19-data"
+    git(tmp_path, "init", "-q", "--bare", str(upstream))
+    git(tmp_path, "clone", "-q", str(upstream), str(seed))
+    groupings = (rollup.nation, rollup.state_of)
+    tails = {name: ingest.CsvTail(str(data / f"{name}.csv")) for name in ("us-counties", "us-states")}
+    key_columns = {"us-counties": ["county", "state"], "us-states": ["state"]}
+    stores = {name: None for name in tails}
+    rollups = {name: None for name in tails}
+    version = None
+    for i, rows in enumerate(commits()):
+        write_csv(seed / "us-counties.csv", county_header, rows)
+        write_csv(seed / "us-states.csv", state_header, state_rows(rows))
+        git(seed, "add", ".")
+        git(seed, "commit", "-q", "-m", f"commit {i}")
+        git(seed, "push", "-q", "origin", "HEAD")
+        if i == 0:
+            git(tmp_path, "clone", "-q", str(upstream), str(data))
+        else:
+            git(data, "pull", "-q")
+        new_version = covid_19.git_version(str(data))
+        for name, tail in tails.items():
+            store, dirty = ingest.update_store(tail, stores[name], key_columns[name], str(data), version, new_version)
+            if i:
+                # only the first commit needs a full ingest
+                assert dirty is not None
+            rollups[name] = rollup.update_rollup(rollups[name] or rollup.Rollup(groupings), stores[name], store, dirty)
+            stores[name] = store
+            expected = covid_19.df_to_store(pd.read_csv(tail.path), key_columns[name])
+            assert_same_store(store, expected)
+            assert_same_rollup(rollups[name], rollup.rollup(expected, groupings))
+        version = new_version
@@ -0,0 +1,104 @@
+"""The FRED fetch layer (unemployment.fetch and update_file) against a local HTTP
+stand-in for FRED, which fred_url_base points at."""
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import unemployment
+
+class FakeFred(BaseHTTPRequestHandler):
+    """Serves server.series[id] (a CSV) with server.etags[id] at /fred?id=..., and
+    redirects /moved?id=... there.  A series is only served once server.release is set."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        fred_id = urllib.parse.parse_qs(parts.query)["id"][0]
+        self.server.requests.append((parts.path, fred_id, self.headers.get("If-None-Match")))
+        if parts.path == "/moved":
+            self.respond(302, headers={"Location": f"/fred?id={fred_id}"})
+            return
+        self.server.release.wait(10)
+        etag = self.server.etags[fred_id]
+        if self.headers.get("If-None-Match") == etag:
+            self.respond(304, headers={"ETag": etag})
+        else:
+            self.respond(200, self.server.series[fred_id].encode(), {"ETag": etag})
+
+    def respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def fred(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeFred)
+    server.requests = []
+    server.series = {"ICSA": "DATE,ICSA\n2020-03-07,211000\n"}
+    server.etags = {"ICSA": '"v1"'}
+    server.release = threading.Event()
+    server.release.set()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    monkeypatch.setattr(unemployment, "fred_url_base", f"http://127.0.0.1:{server.server_port}/fred?id=")
+    monkeypatch.chdir(tmp_path)
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_download_writes_file_and_etag(fred):
+    assert unemployment.update_file("ICSA") == "ICSA.csv"
+    assert read("ICSA.csv") == fred.series["ICSA"]
+    assert unemployment.read_meta("ICSA.csv")["etag"] == '"v1"'
+    assert not [name for name in os.listdir() if name.endswith(".tmp")]
+
+def test_not_modified_keeps_file(fred):
+    unemployment.fetch("ICSA", "ICSA.csv")
+    before = os.stat("ICSA.csv").st_mtime_ns
+    version = unemployment.data_version(["ICSA"])
+    checked = unemployment.read_meta("ICSA.csv")["checked"]
+    unemployment.fetch("ICSA", "ICSA.csv")
+    assert fred.requests[-1] == ("/fred", "ICSA", '"v1"')
+    assert os.stat("ICSA.csv").st_mtime_ns == before
+    assert unemployment.data_version(["ICSA"]) == version
+    assert unemployment.read_meta("ICSA.csv")["checked"] >= checked
+
+def test_stale_file_is_revalidated_in_background(fred):
+    unemployment.fetch("ICSA", "ICSA.csv")
+    meta = unemployment.read_meta("ICSA.csv")
+    meta["checked"] = time.time() - 2 * 24 * 60 * 60
+    unemployment.write_meta("ICSA.csv", meta)
+    fred.series["ICSA"] = "DATE,ICSA\n2020-03-07,211000\n2020-03-14,282000\n"
+    fred.etags["ICSA"] = '"v2"'
+    # the server holds the revalidation, update_file must not wait for it
+    fred.release.clear()
+    old = read("ICSA.csv")
+    assert unemployment.update_file("ICSA") == "ICSA.csv"
+    assert read("ICSA.csv") == old
+    fred.release.set()
+    deadline = time.time() + 10
+    while read("ICSA.csv") == old and time.time() < deadline:
+        time.sleep(0.01)
+    assert read("ICSA.csv") == fred.series["ICSA"]
+    while unemployment.read_meta("ICSA.csv").get("etag") != '"v2"' and time.time() < deadline:
+        time.sleep(0.01)
+    assert unemployment.read_meta("ICSA.csv")["etag"] == '"v2"'
+
+def test_redirect_is_followed(fred, monkeypatch):
+    monkeypatch.setattr(unemployment, "fred_url_base", f"http://127.0.0.1:{fred.server_port}/moved?id=")
+    unemployment.update_file("ICSA")
+    assert [path for path, fred_id, etag in fred.requests] == ["/moved", "/fred"]
+    assert read("ICSA.csv") == fred.series["ICSA"]
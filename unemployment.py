@@ -1,14 +1,19 @@
 import threading
-import urllib.request
+import http.client
+import json
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import os
 import time
 import numpy as np
+import metrics
 
 class UnemploymentDataException(Exception):
     pass
 
-fred_url_base = 'https://fred.stlouisfed.org/graph/fredgraph.csv?id='
+# FRED_URL_BASE can point at another server, e.g. a local stand-in
+fred_url_base = os.environ.get('FRED_URL_BASE', 'https://fred.stlouisfed.org/graph/fredgraph.csv?id=')
 
 plots_config = dict(
     new_claims=dict(fred_id='ICSA', title='Weekly new unemployment claims', xlabel='Date', ylabel='Claims Per Week'),
@@ -17,29 +22,152 @@ plots_config = dict(
     unemployment=dict(fred_id='UNRATE', title='Unemployment', xlabel='date', ylabel='Unemployment (%)'),
 )
 
-update_lock = threading.Lock()
-def get_df(fred_id, local_fn=None, expiry_age = 60*60*24):
-    """Gets the url as a pandas dataframe.  Only retrieves new data once a day"""
+# one kept-alive connection per thread and host
+connections = threading.local()
+
+def request(url, headers, max_redirects=5):
+    """GETs url.  Returns (status, response headers, body)"""
+    for i in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        by_host = connections.__dict__.setdefault("by_host", {})
+        host = (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        for attempt in range(2):
+            if host not in by_host:
+                connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+                by_host[host] = connection_class(parts.netloc, timeout=60)
+            connection = by_host[host]
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server may have closed the kept-alive connection, try a new one
+                connection.close()
+                del by_host[host]
+                if attempt:
+                    raise
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            url = urllib.parse.urljoin(url, response.getheader("Location"))
+            continue
+        return response.status, response.headers, body
+    raise UnemploymentDataException(f"Too many redirects for {url}")
+
+def read_meta(local_fn):
+    """What we know about the download in local_fn: etag, last_modified and when it was last checked"""
+    try:
+        with open(local_fn + ".meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_meta(local_fn, meta):
+    tmp = f"{local_fn}.meta.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, local_fn + ".meta.json")
+
+def fetch(fred_id, local_fn):
+    """Downloads the FRED series to local_fn, unless the server says it didn't change since
+    the last download.  local_fn is only written (atomically) when the data changed."""
+    meta = read_meta(local_fn) if os.path.exists(local_fn) else {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    with metrics.timed("covid_stage_seconds", stage="fred_fetch"):
+        status, response_headers, body = request(fred_url_base + fred_id, headers)
+    if status == 200:
+        tmp = f"{local_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, local_fn)
+        meta = {"etag": response_headers.get("ETag"), "last_modified": response_headers.get("Last-Modified")}
+    elif status != 304:
+        raise UnemploymentDataException(f"Couldn't get {fred_id}: HTTP {status}")
+    meta["checked"] = time.time()
+    write_meta(local_fn, meta)
+
+series_locks = {}
+series_locks_lock = threading.Lock()
+def series_lock(fred_id):
+    """The lock of one FRED series, so different series can be fetched at the same time"""
+    with series_locks_lock:
+        return series_locks.setdefault(fred_id, threading.Lock())
+
+revalidate_pool = ThreadPoolExecutor(max_workers=4)
+def revalidate(fred_id, local_fn):
+    """fetch() in the background, unless that series is already being fetched"""
+    lock = series_lock(fred_id)
+    if not lock.acquire(blocking=False):
+        return
+    def run():
+        try:
+            fetch(fred_id, local_fn)
+        except Exception as e:
+            print(f"Couldn't update {fred_id}: {e}")
+        finally:
+            lock.release()
+    revalidate_pool.submit(run)
+
+def update_file(fred_id, local_fn=None, expiry_age = 60*60*24):
+    """Makes sure the FRED series is in local_fn.  Returns local_fn.
+
+    Only waits for the download if there's no local copy at all.  A copy older than
+    expiry_age is still used, while it's revalidated in the background."""
     if local_fn is None:
         local_fn = f"{fred_id}.csv"
-    url = fred_url_base + fred_id
-    do_update = True
-    if os.path.exists(local_fn):
-        mtime = os.path.getmtime(local_fn)
-        now = time.time()
-        age = now-mtime
-        if age <= expiry_age:
-            do_update = False
-    if do_update:
-        update_lock.acquire()
-        df = None
-        with urllib.request.urlopen(url) as response:
-            data = response.read().decode('UTF-8')
-            with open(local_fn, "w") as f:
-                f.write(data)
-        update_lock.release()
-    df = pd.read_csv(local_fn)
-    return df
+    if not os.path.exists(local_fn):
+        with series_lock(fred_id):
+            if not os.path.exists(local_fn):
+                fetch(fred_id, local_fn)
+    else:
+        checked = read_meta(local_fn).get("checked", os.path.getmtime(local_fn))
+        if time.time() - checked > expiry_age:
+            revalidate(fred_id, local_fn)
+    return local_fn
+
+fetch_pool = ThreadPoolExecutor(max_workers=4)
+def update_files(ids):
+    """update_file() for all the series at the same time"""
+    return list(fetch_pool.map(update_file, ids))
+
+# parsed series, by file name: (mtime, dates, values).  A file is only parsed again
+# when it changes.
+parsed_series = {}
+
+def get_series(fred_id, local_fn=None, expiry_age = 60*60*24):
+    """Gets a FRED series as (dates, values): read only datetime64[D] and float arrays"""
+    local_fn = update_file(fred_id, local_fn, expiry_age)
+    mtime = os.path.getmtime(local_fn)
+    cached = parsed_series.get(local_fn)
+    hit = cached is not None and cached[0] == mtime
+    metrics.count("covid_cache_requests_total", function="parsed_series", result="hit" if hit else "miss")
+    if not hit:
+        with metrics.timed("covid_stage_seconds", stage="fred_parse"):
+            df = pd.read_csv(local_fn)
+            dates = pd.to_datetime(df.iloc[:, 0]).values.astype('datetime64[D]')
+            # FRED writes missing values as "."
+            values = pd.to_numeric(df[fred_id], errors='coerce').values.astype(float)
+        dates.setflags(write=False)
+        values.setflags(write=False)
+        cached = parsed_series[local_fn] = (mtime, dates, values)
+    return cached[1], cached[2]
+
+def get_df(fred_id, local_fn=None, expiry_age = 60*60*24):
+    """Gets the url as a pandas dataframe.  Only retrieves new data once a day"""
+    with metrics.timed("covid_stage_seconds", stage="fred_get_df"):
+        dates, values = get_series(fred_id, local_fn, expiry_age)
+        return pd.DataFrame({'DATE': dates, fred_id: values})
+
+fred_ids = [config['fred_id'] for config in plots_config.values()]
+
+def data_version(ids=fred_ids):
+    """A token that changes whenever one of the FRED files gets new data"""
+    local_fns = update_files(ids)
+    return "-".join(f"{fred_id}:{os.path.getmtime(local_fn):.0f}" for fred_id, local_fn in zip(ids, local_fns))
 
 def get_unemployment(name):
     """retruns 2 data frames unemployment data: new claims and continuing claims.  Can raise an UnemploymentDataException if the data isnt' available."""
@@ -51,10 +179,11 @@ def get_unemployment(name):
     fred_id=config['fred_id']
     df = get_df(fred_id, config['fred_id']+'.csv')
     if 'apply' in config:
-        df[config['fred_id']] = df[config['fred_id']].apply(config['apply'])
+        df[config['fred_id']] = config['apply'](df[config['fred_id']])
     return df, config
 
 def get_unemployment_all():
+    update_files(fred_ids)
     results = {}
     for k in plots_config:
         results[k] = get_unemployment(k)
@@ -62,12 +191,9 @@ def get_unemployment_all():
 
 def get_as_part_of_employment(key):
     """Get's a FRED key as a fraction of the total employment level.  Returns dates, fraction"""
-    icsa = get_df(key)
-    employment = get_df('LNU02000000')
-    x0 = np.array(icsa['DATE'].values, dtype=np.datetime64)
-    y0 = icsa[key].values
-    x1 = np.array(employment['DATE'].values, dtype=np.datetime64)
-    y1 = employment['LNU02000000'].values * 1000
+    x0, y0 = get_series(key)
+    x1, y1 = get_series('LNU02000000')
+    y1 = y1 * 1000
     a = x0.astype(int, casting='unsafe')
     b = x1.astype(int, casting='unsafe')
     interp_employ = np.interp(a, b, y1)
@@ -80,9 +206,7 @@ def get_excess_covid_claims():
     The level before that was 211k claims, then 282k, then 3,030k and up
     This function returns the integral of (claims-211k) starting on 3/14
     """
-    icsa_df = get_df('ICSA')
-    icsa_values = icsa_df['ICSA']
-    icsa_dates = np.array(icsa_df['DATE'].values, dtype=np.datetime64)
+    icsa_dates, icsa_values = get_series('ICSA')
     starting_idx = np.argmin(np.abs(icsa_dates-np.datetime64('2020-03-07')))
     base_value = icsa_values[starting_idx]
     x = icsa_dates[starting_idx:]